@@ -1,41 +1,44 @@
 # exif.py
-from exif import Image
-from orbit import get_height_at
+from orbit import get_speed_approx
 from datetime import datetime
-import cv2
 import math
+import os
+import threading
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from statistics import median
-from typing import List, Tuple, Optional, Literal
+from typing import List, Tuple, Optional, Literal, NamedTuple
 import calc
 from config import get_gsdnapix
 import numpy as np
-from picamzero import Camera
-from fotak import take_photo
+from features import (DiskFeatureStore, FeatureStore, Frame, MATCH_DTYPE, frame_key, keypoints_to_array,
+                      knn_to_arrays, points, to_cv_keypoints, to_cv_matches)
+from lazy import LazyModule
+import profiling
+from profiling import span
+from exiftime import read_time
+from motion import MotionModel, estimate_motion
+
+# OpenCV takes a while to import, only load it once images are processed
+cv2 = LazyModule("cv2")
 
 Point = Tuple[float, float]
 Pair = Tuple[Point, Point]
 from pathlib import Path
+
+# decoded + detected frames, shared between consecutive pairs
+FEATURE_STORE = FeatureStore(maxsize=4)
+# keypoints + descriptors across runs, reprocessing an archive skips ORB (ASTROPI_FEATURE_CACHE=dir)
+DISK_STORE: DiskFeatureStore | None = \
+    DiskFeatureStore(os.environ["ASTROPI_FEATURE_CACHE"]) if os.environ.get("ASTROPI_FEATURE_CACHE") else None
+
 def _prep(gray):
     # Boost contrast so ORB finds more stable keypoints on haze/ocean/clouds
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
     return clahe.apply(gray)
 
 
-def photo_and_process(cam, last_photo=None) -> tuple[str, float | None]:
-    photo = take_photo('image', 'images/', cam)
-    if last_photo is not None:
-        try:
-            speed = EXIF.run(last_photo, photo)[0]
-        except Exception as e:
-            print(f"EXIF failed for {last_photo} -> {photo}: {e}")
-            speed = None
-    else:
-        speed = None
-    return (str(photo), speed)
-
-
 def get_time_difference(image_1: str, image_2: str) -> float:
     # Try filename timestamps first: prefix_1234567890.123.jpg
     try:
@@ -43,19 +46,15 @@ def get_time_difference(image_1: str, image_2: str) -> float:
         t2 = float(Path(image_2).stem.split("_")[-1])
         return abs(t2 - t1)
     except Exception:
-        # fallback to EXIF seconds
+        # fallback to the EXIF capture times (sub-second if the camera wrote SubSecTimeOriginal)
         time_1 = get_time(image_1)
         time_2 = get_time(image_2)
         return abs((time_2 - time_1).total_seconds())
 
 
 def get_time(image_path: str) -> datetime:
-    with open(image_path, "rb") as image_file:
-        img = Image(image_file)
-        time_str = img.get("datetime_original")
-        if not time_str:
-            raise ValueError(f"No datetime_original EXIF tag found in {image_path}")
-        return datetime.strptime(time_str, "%Y:%m:%d %H:%M:%S")
+    # header only and cached, see exiftime.py
+    return read_time(image_path)
 
 
 def convert_to_cv(image_1: str, image_2: str):
@@ -68,19 +67,204 @@ def convert_to_cv(image_1: str, image_2: str):
     return image_1_cv, image_2_cv
 
 
-def calculate_features(image_1_cv, image_2_cv, feature_number: int):
-    image_1_cv = _prep(image_1_cv)
-    image_2_cv = _prep(image_2_cv)
+DARK_LEVEL = 25         # below this the thumbnail is porthole frame / night
+BRIGHT_LEVEL = 235      # above this it's saturated cloud, which moves on its own
+MIN_TEXTURE = 4.0       # local std dev, below this it's blank ocean / haze
+ROI_THUMB = 8           # the ROI mask is computed on a 1/ROI_THUMB thumbnail
+
+
+def roi_mask(gray):
+    """
+    ORB mask of the usable part of a frame: drops the dark porthole vignette,
+    saturated clouds and textureless areas. None if (almost) nothing is left,
+    then the whole frame is used.
+    """
+    h, w = gray.shape[:2]
+    thumb = cv2.resize(gray, (max(1, w // ROI_THUMB), max(1, h // ROI_THUMB)), interpolation=cv2.INTER_AREA)
+    mask = cv2.morphologyEx(_usable(thumb).astype(np.uint8) * 255, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    if cv2.countNonZero(mask) < 0.05 * mask.size:
+        return None
+    return cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+
+
+def _usable(thumb) -> np.ndarray:
+    # neither dark, saturated nor blank, per thumbnail pixel
+    blurred = cv2.GaussianBlur(thumb, (5, 5), 0).astype(np.float32)
+    mean = cv2.blur(blurred, (7, 7))
+    std = np.sqrt(np.maximum(cv2.blur(blurred * blurred, (7, 7)) - mean * mean, 0))
+    return (blurred > DARK_LEVEL) & (blurred < BRIGHT_LEVEL) & (std > MIN_TEXTURE)
+
+
+def usable_fraction(image) -> float:
+    """
+    Share of a photo worth matching (see roi_mask), from a 1/8 size decode so
+    it is cheap enough to check every frame before it is queued. `image` is a
+    path or a grayscale frame in memory.
+    """
+    if isinstance(image, np.ndarray):
+        h, w = image.shape[:2]
+        thumb = cv2.resize(image, (max(1, w // ROI_THUMB), max(1, h // ROI_THUMB)), interpolation=cv2.INTER_AREA)
+    else:
+        thumb = cv2.imread(str(image), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if thumb is None:
+        raise FileNotFoundError(f"OpenCV could not read {image}")
+    return float(_usable(thumb).mean())
+
+
+ORB_SCALE_FACTOR = 1.2
+ORB_LEVELS = 8
+ORB_EDGE_THRESHOLD = 40     # px border without keypoints, per pyramid level
+ORB_PATCH_SIZE = 31         # OpenCV default, the descriptor patch at each level
 
-    orb = cv2.ORB_create(
+
+def make_orb(feature_number: int):
+    return cv2.ORB_create(
         nfeatures=feature_number,
-        scaleFactor=1.2,
-        nlevels=8,
-        edgeThreshold=40,
+        scaleFactor=ORB_SCALE_FACTOR,
+        nlevels=ORB_LEVELS,
+        edgeThreshold=ORB_EDGE_THRESHOLD,
+        patchSize=ORB_PATCH_SIZE,
         fastThreshold=7,
     )
-    keypoints_1, descriptors_1 = orb.detectAndCompute(image_1_cv, None)
-    keypoints_2, descriptors_2 = orb.detectAndCompute(image_2_cv, None)
+
+
+def to_full_resolution(keypoints: np.ndarray, scale: float) -> np.ndarray:
+    # keypoints found on a copy resized by `scale` -> full resolution pixels
+    if scale != 1.0:
+        for field in ("x", "y", "size"):
+            keypoints[field] /= scale
+    return keypoints
+
+
+# px around each tile: the ORB border plus half a patch at the coarsest pyramid level (~200 px),
+# so keypoints of every octave next to a seam are still found by the tile owning them
+TILE_OVERLAP = math.ceil((ORB_EDGE_THRESHOLD + ORB_PATCH_SIZE / 2) * ORB_SCALE_FACTOR ** (ORB_LEVELS - 1))
+DETECT_WORKERS = os.cpu_count() or 1
+
+_detect_pool: ThreadPoolExecutor | None = None
+_frame_pool: ThreadPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _pools() -> tuple[ThreadPoolExecutor, ThreadPoolExecutor]:
+    # tiles and frames get separate pools, a frame waiting on its tiles can't starve them
+    global _detect_pool, _frame_pool
+    with _pool_lock:
+        if _detect_pool is None:
+            _detect_pool = ThreadPoolExecutor(DETECT_WORKERS, thread_name_prefix="orb-tile")
+            _frame_pool = ThreadPoolExecutor(2, thread_name_prefix="orb-frame")
+        return _detect_pool, _frame_pool
+
+
+def tile_grid(shape, tiles: tuple[int, int], overlap: int = TILE_OVERLAP):
+    """
+    (core, padded) boxes as (x0, y0, x1, y1) for a cols x rows grid. The cores
+    cover the frame exactly once, the padded boxes add `overlap` on every side.
+    """
+    h, w = shape[:2]
+    cols, rows = tiles
+    xs = np.linspace(0, w, cols + 1).astype(int)
+    ys = np.linspace(0, h, rows + 1).astype(int)
+    return [((xs[i], ys[j], xs[i + 1], ys[j + 1]),
+             (max(0, xs[i] - overlap), max(0, ys[j] - overlap), min(w, xs[i + 1] + overlap), min(h, ys[j + 1] + overlap)))
+            for j in range(rows) for i in range(cols)]
+
+
+def _detect_tile(gray, mask, core, padded, quota: int):
+    # CLAHE + ORB on one padded tile, only the keypoints inside its core are kept,
+    # so ORB gets the quota for the whole padded area
+    px0, py0, px1, py1 = padded
+    cx0, cy0, cx1, cy1 = core
+    padded_quota = math.ceil(quota * (px1 - px0) * (py1 - py0) / max(1, (cx1 - cx0) * (cy1 - cy0)))
+    tile_mask = mask[py0:py1, px0:px1] if mask is not None else None
+    keypoints, descriptors = make_orb(padded_quota).detectAndCompute(_prep(gray[py0:py1, px0:px1]), tile_mask)
+    keypoints = keypoints_to_array(keypoints)
+    if descriptors is None:
+        return keypoints[:0], None
+    keypoints["x"] += px0
+    keypoints["y"] += py0
+    kept = (keypoints["x"] >= cx0) & (keypoints["x"] < cx1) & (keypoints["y"] >= cy0) & (keypoints["y"] < cy1)
+    if not kept.any():
+        return keypoints[:0], None
+    keypoints, descriptors = keypoints[kept], descriptors[kept]
+    if len(keypoints) > quota:
+        best = np.argsort(-keypoints["response"], kind="stable")[:quota]
+        keypoints, descriptors = keypoints[best], descriptors[best]
+    return keypoints, descriptors
+
+
+def detect_tiled(gray, feature_number: int, tiles: tuple[int, int] = (4, 3), mask=None):
+    """
+    ORB per tile on the detect pool (OpenCV drops the GIL), each tile with an
+    equal share of `feature_number`, so keypoints spread over the whole frame
+    instead of piling up on the most textured part.
+    """
+    grid = tile_grid(gray.shape, tiles)
+    quota = math.ceil(feature_number / len(grid))
+    pool, _ = _pools()
+    results = [f.result() for f in [pool.submit(_detect_tile, gray, mask, core, padded, quota) for core, padded in grid]]
+
+    keypoints = np.concatenate([kps for kps, _ in results])
+    descriptors = [d for _, d in results if d is not None]
+    return keypoints, (np.vstack(descriptors) if descriptors else None)
+
+
+def detect_features(gray, feature_number: int, scale: float = 1.0, roi: bool = False,
+                    tiles: tuple[int, int] | None = None):
+    """
+    ORB on the frame, optionally at a reduced working resolution (`scale`),
+    only inside roi_mask() and split into `tiles` (cols, rows) detected in
+    parallel. Returns a features.KEYPOINT_DTYPE array, always in full
+    resolution pixels, and the descriptors.
+    """
+    if scale != 1.0:
+        with span("resize"):
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    mask = None
+    if roi:
+        with span("roi"):
+            mask = roi_mask(gray)
+
+    if tiles is not None:
+        with span("orb"):
+            keypoints, descriptors = detect_tiled(gray, feature_number, tiles, mask)
+        return to_full_resolution(keypoints, scale), descriptors
+
+    with span("_prep"):
+        prepped = _prep(gray)
+    with span("orb"):
+        keypoints, descriptors = make_orb(feature_number).detectAndCompute(prepped, mask)
+    return to_full_resolution(keypoints_to_array(keypoints), scale), descriptors
+
+
+def refine_points(image_1_cv, image_2_cv, pts1, pts2, window: int = 21):
+    """
+    Coarse-to-fine step: track pts1 into the full resolution image 2 with
+    Lucas-Kanade, starting from the coarse matches pts2.
+    Returns the refined pts2 and a mask of the points that were tracked.
+    """
+    refined, status, _ = cv2.calcOpticalFlowPyrLK(
+        image_1_cv, image_2_cv, pts1, pts2.copy(),
+        winSize=(window, window), maxLevel=1,
+        criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+        flags=cv2.OPTFLOW_USE_INITIAL_FLOW,
+    )
+    tracked = status.ravel().astype(bool)
+    # LK may wander off to a different feature, it should only fix the quantisation
+    tracked &= np.hypot(*(refined - pts2).reshape(-1, 2).T) < window / 2
+    return refined, tracked
+
+
+def calculate_features(image_1_cv, image_2_cv, feature_number: int, tiles: tuple[int, int] | None = None):
+    if tiles is None:
+        keypoints_1, descriptors_1 = detect_features(image_1_cv, feature_number)
+        keypoints_2, descriptors_2 = detect_features(image_2_cv, feature_number)
+    else:
+        # both frames at once, their tiles share the detect pool
+        _, frames = _pools()
+        first = frames.submit(detect_features, image_1_cv, feature_number, tiles=tiles)
+        keypoints_2, descriptors_2 = detect_features(image_2_cv, feature_number, tiles=tiles)
+        keypoints_1, descriptors_1 = first.result()
 
     if descriptors_1 is None or descriptors_2 is None:
         raise ValueError("Could not compute descriptors (images too blurry/dark?).")
@@ -88,47 +272,351 @@ def calculate_features(image_1_cv, image_2_cv, feature_number: int):
     return keypoints_1, keypoints_2, descriptors_1, descriptors_2
 
 
-def calculate_matches(descriptors_1, descriptors_2):
+def _decode_frame(image: str, feature_number: int, scale: float = 1.0, roi: bool = False,
+                  tiles: tuple[int, int] | None = None) -> Frame:
+    if DISK_STORE is None:
+        with span("decode"):
+            gray = cv2.imread(str(image), 0)
+        if gray is None:
+            raise FileNotFoundError(f"OpenCV could not read {image}")
+        return Frame(gray, *detect_features(gray, feature_number, scale, roi, tiles))
+
+    # the file is read once, for the content hash and the decoder
+    with span("decode"):
+        data = Path(image).read_bytes()
+        gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise FileNotFoundError(f"OpenCV could not read {image}")
+    key = DiskFeatureStore.key(data, feature_number, scale, roi, tiles)
+    cached = DISK_STORE.load(key)
+    if cached is not None:
+        return Frame(gray, *cached)
+    keypoints, descriptors = detect_features(gray, feature_number, scale, roi, tiles)
+    DISK_STORE.save(key, keypoints, descriptors)
+    return Frame(gray, keypoints, descriptors)
+
+
+def load_frame(image: str, feature_number: int, store: FeatureStore | None = FEATURE_STORE,
+               scale: float = 1.0, roi: bool = False, tiles: tuple[int, int] | None = None) -> Frame:
+    """
+    Decode and ORB-process one image, reusing the result from `store` if this
+    file was already processed with the same settings, and the keypoints from
+    DISK_STORE if it was processed in an earlier run.
+    """
+    if store is None:
+        return _decode_frame(image, feature_number, scale, roi, tiles)
+    key = frame_key(image, feature_number, scale, roi, tiles)
+    return store.get_or_load(key, lambda: _decode_frame(image, feature_number, scale, roi, tiles))
+
+
+def load_array(name: str, gray, feature_number: int, store: FeatureStore | None = FEATURE_STORE,
+               scale: float = 1.0, roi: bool = False, tiles: tuple[int, int] | None = None) -> Frame:
+    """load_frame() for a grayscale frame already in memory, `name` keys it in `store`"""
+    if store is None:
+        return Frame(gray, *detect_features(gray, feature_number, scale, roi, tiles))
+    key = ("memory", name, feature_number, scale, roi, tiles)
+    return store.get_or_load(key, lambda: Frame(gray, *detect_features(gray, feature_number, scale, roi, tiles)))
+
+
+def load_pair(load, first: tuple, second: tuple, tiles: tuple[int, int] | None = None,
+              **options) -> tuple[Frame, Frame]:
+    """
+    load(*first, **options) and load(*second, **options). With tiles both
+    frames are detected at the same time, their tiles share the detect pool.
+    """
+    if tiles is None:
+        return load(*first, **options), load(*second, **options)
+    _, frames = _pools()
+    frame_1 = frames.submit(profiling.collected, load, *first, tiles=tiles, **options)
+    frame_2 = load(*second, tiles=tiles, **options)
+    frame_1, stages = frame_1.result()
+    # the decode and ORB time of frame 1 belong to this pair too
+    profiling.merge(stages)
+    return frame_1, frame_2
+
+
+class MotionPrior(NamedTuple):
+    """Where the features of image 1 are expected to show up in image 2"""
+    length: float                           # expected shift in pixels
+    shift: Tuple[float, float] | None       # expected (dx, dy) if the heading is known
+    tolerance: float = 0.25                 # allowed error, fraction of length
+
+
+class SharedVelocity:
+    """
+    Image motion (px/s) of the last successful pair of any worker, the
+    heading for the next guided prior. Shared between worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._velocity: np.ndarray | None = None
+
+    def get(self) -> np.ndarray | None:
+        with self._lock:
+            return None if self._velocity is None else self._velocity.copy()
+
+    def update(self, velocity) -> None:
+        with self._lock:
+            self._velocity = np.array(velocity, dtype=np.float64).ravel()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._velocity = None
+
+
+LAST_VELOCITY = SharedVelocity()
+# transform of the last successful pair, the first guess for the next one
+MOTION_MODEL = MotionModel()
+
+
+class MatchQuality(NamedTuple):
+    matches: int        # after clear_matches (and refinement)
+    inliers: int        # RANSAC inliers
+
+
+class MatchedPair(NamedTuple):
+    # the RANSAC inliers of one ORB pair, what tracker.MultiFrameSolver chains into tracks
+    time: object            # capture time of image 1 (datetime or unix seconds)
+    time_difference: float
+    matches: np.ndarray     # features.MATCH_DTYPE
+    pts1: np.ndarray        # (N, 1, 2)
+    pts2: np.ndarray
+
+
+# how the last pair of this thread was measured, read by main.py for the journal and scheduler:
+# last.tier is "phase" or "orb", last.quality the MatchQuality of the ORB tier (None for phase),
+# last.velocity the image motion of this pair in px/s (LAST_VELOCITY is whichever pair finished last),
+# last.matched the MatchedPair of the ORB tier (None for phase)
+last = threading.local()
+
+PHASE_REDUCE = 4        # phase correlation on 1/4 size frames (IMREAD_REDUCED_GRAYSCALE_4 for files)
+MIN_PEAK = 0.1          # cv2.phaseCorrelate response needed, unrelated frames or noise give ~0.01
+
+
+class PhaseEstimate(NamedTuple):
+    shift: Tuple[float, float]      # full resolution px, image 1 -> image 2
+    response: float                 # peak confidence, 0..1
+    size: Tuple[int, int]           # full resolution (w, h) of the frames
+
+
+def _phase_thumb(image):
+    if isinstance(image, np.ndarray):
+        h, w = image.shape[:2]
+        thumb = cv2.resize(image, (w // PHASE_REDUCE, h // PHASE_REDUCE), interpolation=cv2.INTER_AREA)
+    else:
+        # the JPEG decoder scales down for free
+        thumb = cv2.imread(str(image), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        if thumb is None:
+            raise FileNotFoundError(f"OpenCV could not read {image}")
+    return thumb.astype(np.float32)
+
+
+def phase_shift(image_1, image_2) -> PhaseEstimate:
+    """
+    Translation between two frames (paths or grayscale arrays) from the
+    phase correlation of Hann windowed thumbnails. Rotation is ignored,
+    between two ISS photos it is a fraction of a degree.
+    """
+    thumb_1, thumb_2 = _phase_thumb(image_1), _phase_thumb(image_2)
+    window = cv2.createHanningWindow(thumb_1.shape[::-1], cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(thumb_1, thumb_2, window)
+    h, w = thumb_1.shape
+    return PhaseEstimate((dx * PHASE_REDUCE, dy * PHASE_REDUCE), float(response), (w * PHASE_REDUCE, h * PHASE_REDUCE))
+
+
+def phase_speed(image_1, image_2, time, time_difference: float, orbit_state: calc.OrbitState) -> float | None:
+    """
+    The fast tier: speed of the frame centre moved by phase_shift(), None if
+    the correlation peak is too weak or the speed is outside the calc gate.
+    """
+    with span("phase"):
+        estimate = phase_shift(image_1, image_2)
+    if estimate.response < MIN_PEAK:
+        return None
+    centre = np.array(estimate.size, dtype=np.float64) / 2
+    shift = np.array(estimate.shift)
+    speeds = calc.get_speeds([centre], [centre + shift], time, time_difference, state=orbit_state)
+    if not calc.speed_mask(speeds)[0]:
+        return None
+    last.tier, last.quality, last.velocity, last.matched = "phase", None, shift / time_difference, None
+    LAST_VELOCITY.update(last.velocity)
+    return float(speeds[0])
+
+
+def motion_prior(time, time_difference: float, orbit_state: calc.OrbitState,
+                 velocity: np.ndarray | None = None) -> MotionPrior:
+    """
+    Expected ground-track shift between two photos from the orbit: the ISS
+    speed projected down to the ground, divided by the GSD. The direction is
+    taken from `velocity` (px/s, normally the previous pair) when known.
+    """
+    ground_speed_m_s = get_speed_approx(time) * 1000 * orbit_state.radius / orbit_state.orbital_radius
+    gsd_m = get_gsdnapix(time, orbit_state.height) / 100.0
+    length = ground_speed_m_s * time_difference / gsd_m
+
+    if velocity is None:
+        return MotionPrior(length, None)
+    dx, dy = velocity * time_difference
+    return MotionPrior(length, (float(dx), float(dy)))
+
+
+def match_bruteforce(keypoints_1, keypoints_2, descriptors_1, descriptors_2, prior: MotionPrior | None = None):
     bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-    knn = bf.knnMatch(descriptors_1, descriptors_2, k=2)
-    matches = [m[0] for m in knn]
-    return knn, matches
+    return knn_to_arrays(bf.knnMatch(descriptors_1, descriptors_2, k=2))
 
-def clear_matches(knn, keypoints_1, keypoints_2, matches, height: float, time_diff: float):
-    points1, points2 = find_matching_coordinates(keypoints_1, keypoints_2, matches)
-    to_remove: list[int] = []
-    
-    shortest_dist = calc.minimum_pixel_diff(time_diff, height)[0]
-    #print(shortest_dist)
-    
-    for i, (pos1, pos2) in enumerate(zip(points1, points2)):
-        pixel_distance = math.sqrt(pow(pos1[0] - pos2[0], 2) + pow(pos1[1] - pos2[1], 2))
-        #print(pixel_distance, shortest_dist)
-        if pixel_distance < shortest_dist:
-            to_remove.append(i)
-            
-    good = []
-    for i, m_n in enumerate(knn):
-        if len(m_n) != 2 or i in to_remove:
+
+FLANN_INDEX_LSH = 6
+
+def match_flann(keypoints_1, keypoints_2, descriptors_1, descriptors_2, prior: MotionPrior | None = None):
+    # approximate nearest neighbours, hashing the binary ORB descriptors
+    index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+    flann = cv2.FlannBasedMatcher(index_params, dict(checks=50))
+    return knn_to_arrays(flann.knnMatch(descriptors_1, descriptors_2, k=2))
+
+
+GUIDED_CHUNK = 512      # image 1 keypoints per mask, bounds the mask memory
+MIN_CELL = 16.0         # px, smallest grid cell for guided matching
+
+# number of set bits for every byte value, for Hamming distances in numpy
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _hamming(descriptors_1, descriptors_2):
+    # (n1, n2) Hamming distances between two sets of binary descriptors
+    if hasattr(np, "bitwise_count") and descriptors_1.shape[1] % 8 == 0:
+        # numpy >= 2: popcount 64 bits at a time
+        xor = descriptors_1.view(np.uint64)[:, None, :] ^ descriptors_2.view(np.uint64)[None, :, :]
+        return np.bitwise_count(xor).sum(axis=2, dtype=np.int32)
+    xor = descriptors_1[:, None, :] ^ descriptors_2[None, :, :]
+    return _POPCOUNT[xor].sum(axis=2, dtype=np.int32)
+
+
+def _match_ring(points_1, points_2, descriptors_1, descriptors_2, prior: MotionPrior):
+    # heading unknown: anything on a ring of the expected length is a candidate
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+    max_err = prior.tolerance * prior.length
+    matches, second = [], []
+    for start in range(0, len(points_1), GUIDED_CHUNK):
+        chunk = slice(start, start + GUIDED_CHUNK)
+        d = points_2[None, :, :] - points_1[chunk, None, :]
+        mask = (np.abs(np.hypot(d[..., 0], d[..., 1]) - prior.length) <= max_err).astype(np.uint8)
+        best, second_distance = knn_to_arrays(bf.knnMatch(descriptors_1[chunk], descriptors_2, k=2, mask=mask))
+        best["query"] += start
+        matches.append(best)
+        second.append(second_distance)
+    return np.concatenate(matches), np.concatenate(second)
+
+
+def _match_grid(points_1, points_2, descriptors_1, descriptors_2, prior: MotionPrior):
+    # heading known: bin image 2 into cells as big as the search radius, then every
+    # predicted position only needs the 3x3 cells around it
+    radius = prior.tolerance * prior.length
+    cell = max(radius, MIN_CELL)
+
+    cells_2 = np.floor(points_2 / cell).astype(np.int64)
+    order = np.lexsort((cells_2[:, 1], cells_2[:, 0]))
+    keys, starts = np.unique(cells_2[order], axis=0, return_index=True)
+    ends = np.append(starts[1:], len(order))
+    bins = {(int(cx), int(cy)): order[a:b] for (cx, cy), a, b in zip(keys, starts, ends)}
+
+    predicted = points_1 + np.asarray(prior.shift, dtype=np.float32)
+    cells_1 = np.floor(predicted / cell).astype(np.int64)
+    # queries predicted into the same cell share one candidate set
+    query_cells, group = np.unique(cells_1, axis=0, return_inverse=True)
+    group = group.ravel()
+    by_group = np.argsort(group, kind="stable")
+    bounds = np.cumsum(np.bincount(group, minlength=len(query_cells)))
+
+    matches, second = [], []
+    for (cx, cy), end, count in zip(query_cells, bounds, np.bincount(group)):
+        queries = by_group[end - count:end]
+        candidates = [bins.get((int(cx) + i, int(cy) + j)) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+        candidates = [c for c in candidates if c is not None]
+        if not candidates:
             continue
-        m, n = m_n
-        if m.distance < 0.75 * n.distance:
-            good.append(m)
+        candidates = np.concatenate(candidates)
+
+        dist = _hamming(descriptors_1[queries], descriptors_2[candidates]).astype(np.float32)
+        offset = points_2[candidates][None, :, :] - predicted[queries][:, None, :]
+        dist[np.hypot(offset[..., 0], offset[..., 1]) > radius] = np.inf
+
+        nearest = np.argsort(dist, axis=1)[:, :2]
+        rows = np.arange(len(queries))
+        best = dist[rows, nearest[:, 0]]
+        found = np.isfinite(best)
+        group_matches = np.empty(int(found.sum()), MATCH_DTYPE)
+        group_matches["query"] = queries[found]
+        group_matches["train"] = candidates[nearest[found, 0]]
+        group_matches["distance"] = best[found]
+        matches.append(group_matches)
+        second.append(dist[rows, nearest[:, 1]][found] if nearest.shape[1] > 1 else np.full(found.sum(), np.inf))
+
+    if not matches:
+        return np.empty(0, MATCH_DTYPE), np.empty(0, np.float32)
+    matches, second = np.concatenate(matches), np.concatenate(second).astype(np.float32)
+    order = np.argsort(matches["query"], kind="stable")
+    return matches[order], second[order]
+
+
+def match_guided(keypoints_1, keypoints_2, descriptors_1, descriptors_2, prior: MotionPrior | None = None):
+    """
+    Only compare descriptors of keypoints whose displacement fits the motion
+    prior. With a known heading this is a grid lookup around the predicted
+    position, so the cost grows about linearly with the number of features.
+    """
+    if prior is None:
+        raise ValueError("Guided matching needs a motion prior.")
+    points_1, points_2 = points(keypoints_1), points(keypoints_2)
+
+    if prior.shift is None:
+        return _match_ring(points_1, points_2, descriptors_1, descriptors_2, prior)
+    return _match_grid(points_1, points_2, descriptors_1, descriptors_2, prior)
+
+
+# RANSAC iterations per matcher, default 2000
+RANSAC_ITERS = {"guided": 200}
+
+# every backend returns (matches, second_distance): a features.MATCH_DTYPE array with the
+# best match of each query and the distance of its second best (inf if there is none)
+MATCHERS = {
+    "bf": match_bruteforce,
+    "flann": match_flann,
+    "guided": match_guided,
+}
+
+
+def calculate_matches(descriptors_1, descriptors_2, matcher: str = "bf",
+                      keypoints_1=None, keypoints_2=None, prior: MotionPrior | None = None):
+    try:
+        match = MATCHERS[matcher]
+    except KeyError:
+        raise ValueError(f"Unknown matcher {matcher!r}, use one of {', '.join(MATCHERS)}.") from None
+    return match(keypoints_1, keypoints_2, descriptors_1, descriptors_2, prior)
+
+def clear_matches(matches, second_distance, keypoints_1, keypoints_2, height: float, time_diff: float):
+    """
+    Keep matches that move at least the minimum expected pixel distance
+    and pass Lowe's ratio test, sorted by descriptor distance.
+    Done as one numpy mask, so it stays linear in the number of matches.
+    """
+    distance = matches["distance"]
 
+    shortest_dist = calc.minimum_pixel_diff(time_diff, height)[0]
+    #print(shortest_dist)
 
-    return sorted(good, key=lambda x: x.distance)
+    points1, points2 = find_matching_coordinates(keypoints_1, keypoints_2, matches)
+    pixel_distance = np.hypot(*(points1 - points2).T)
 
+    # a match without a second neighbour can't pass the ratio test
+    keep = (pixel_distance >= shortest_dist) & np.isfinite(second_distance) & (distance < 0.75 * second_distance)
+    good = np.flatnonzero(keep)
+    return matches[good[np.argsort(distance[good], kind="stable")]]
 
 
 def find_matching_coordinates(keypoints_1, keypoints_2, matches):
-    coordinates_1 = []
-    coordinates_2 = []
-    for match in matches:
-        (x1, y1) = keypoints_1[match.queryIdx].pt
-        (x2, y2) = keypoints_2[match.trainIdx].pt
-        coordinates_1.append((x1, y1))
-        coordinates_2.append((x2, y2))
-    return coordinates_1, coordinates_2
+    """(N, 2) float32 arrays of the matched keypoint positions in both images"""
+    return points(keypoints_1[matches["query"]]), points(keypoints_2[matches["train"]])
 
 
 import math
@@ -215,10 +703,74 @@ def calculate_speed_in_kmps(feature_distance_px: float, gsdnapix: float, time_di
 
 
 def save_matches_image(image_1_cv, keypoints_1, image_2_cv, keypoints_2, matches, out_path: str):
-    match_img = cv2.drawMatches(image_1_cv, keypoints_1, image_2_cv, keypoints_2, matches[:100], None)
+    match_img = cv2.drawMatches(image_1_cv, to_cv_keypoints(keypoints_1), image_2_cv, to_cv_keypoints(keypoints_2),
+                                to_cv_matches(matches[:100]), None)
     cv2.imwrite(out_path, match_img)
 
 
+def match_frames(frame_1: Frame, frame_2: Frame, time, time_difference: float, orbit_state: calc.OrbitState,
+                 matcher: str = "bf", scale: float = 1.0, debug: bool = False):
+    """
+    Match two processed frames: kNN matching, clear_matches, the full
+    resolution refinement and RANSAC.
+    Returns (inlier_matches, pts1, pts2): a features.MATCH_DTYPE array and the
+    inlier points as (N, 1, 2) arrays.
+    """
+    if frame_1.descriptors is None or frame_2.descriptors is None:
+        raise ValueError("Could not compute descriptors (images too blurry/dark?).")
+
+    image_1_cv, keypoints_1, descriptors_1 = frame_1
+    image_2_cv, keypoints_2, descriptors_2 = frame_2
+
+    prior = None
+    if matcher == "guided":
+        prior = motion_prior(time, time_difference, orbit_state, LAST_VELOCITY.get())
+    with span("matching"):
+        matches, second_distance = calculate_matches(descriptors_1, descriptors_2, matcher,
+                                                     keypoints_1, keypoints_2, prior)
+    if debug:
+        save_matches_image(image_1_cv, keypoints_1, image_2_cv, keypoints_2, matches, "err1.jpg")
+    with span("filtering"):
+        matches = clear_matches(matches, second_distance, keypoints_1, keypoints_2,
+                                orbit_state.height, time_difference)
+    if debug:
+        save_matches_image(image_1_cv, keypoints_1, image_2_cv, keypoints_2, matches, "err2.jpg")
+
+    if len(matches) < 20:
+        raise ValueError(f"Too few matches ({len(matches)}).")
+
+    # --- Build matched point arrays
+    pts1, pts2 = find_matching_coordinates(keypoints_1, keypoints_2, matches)
+    pts1 = pts1.reshape(-1, 1, 2)
+    pts2 = pts2.reshape(-1, 1, 2)
+
+    if scale != 1.0:
+        # detected at low resolution, get the full resolution positions back
+        with span("refine"):
+            pts2, tracked = refine_points(image_1_cv, image_2_cv, pts1, pts2)
+        pts1, pts2 = pts1[tracked], pts2[tracked]
+        matches = matches[tracked]
+        if len(matches) < 20:
+            raise ValueError(f"Too few matches after refinement ({len(matches)}).")
+
+    # --- Robustly estimate motion and keep only inliers
+    # Affine partial: translation + rotation + scale (good for small viewpoint changes)
+    # guided matches are already close to the expected motion, few outliers left
+    # seeded from the previous pair, PROSAC and then full RANSAC only if that fails
+    with span("ransac"):
+        estimate = estimate_motion(pts1, pts2, matches["distance"],
+                                   MOTION_MODEL.predict(time_difference),
+                                   max_iters=RANSAC_ITERS.get(matcher, 2000))
+
+    inlier_mask = estimate.inliers
+    MOTION_MODEL.update(estimate.M, time_difference)
+    last.tier, last.quality = "orb", MatchQuality(len(matches), int(inlier_mask.sum()))
+    last.velocity = np.median(pts2[inlier_mask] - pts1[inlier_mask], axis=0).ravel() / time_difference
+    LAST_VELOCITY.update(last.velocity)
+    last.matched = MatchedPair(time, time_difference, matches[inlier_mask], pts1[inlier_mask], pts2[inlier_mask])
+    return last.matched.matches, last.matched.pts1, last.matched.pts2
+
+
 def run(
     image_1: str,
     image_2: str,
@@ -226,71 +778,98 @@ def run(
     nfeatures: int = 4000,
     save_matches: str | None = None,
     height: float | None = None,
-    debug: bool = False
+    debug: bool = False,
+    orbit_state: calc.OrbitState | None = None,
+    matcher: str = "bf",
+    scale: float = 1.0,
+    roi: bool = False,
+    tiles: tuple[int, int] | None = None,
+    phase: bool = True,
 ):
     print("running exif on pictures: ", image_1, image_2)
     time = get_time(image_1)
 
-    if gsdnapix is None:
-        gsdnapix = get_gsdnapix(time)
+    # one orbit lookup per pair, however many matches there are
+    if orbit_state is None:
+        orbit_state = calc.get_orbit_state(time, height=height)
 
     if height is None:
-        height = get_height_at(time)
+        height = orbit_state.height
+
+    if gsdnapix is None:
+        gsdnapix = get_gsdnapix(time, height)
 
     time_difference = get_time_difference(image_1, image_2)
     if time_difference <= 0:
         raise ValueError("Time difference is zero or negative.")
 
-    image_1_cv, image_2_cv = convert_to_cv(image_1, image_2)
-    keypoints_1, keypoints_2, descriptors_1, descriptors_2 = calculate_features(
-        image_1_cv, image_2_cv, nfeatures
-    )
+    # fast tier first, the features only when the correlation isn't convincing
+    if phase and (speed_kmps := phase_speed(image_1, image_2, time, time_difference, orbit_state)) is not None:
+        print(f"image: {image_2}, speed: {speed_kmps:.03f} km/s (phase correlation)")
+        return speed_kmps, [speed_kmps]
 
-    knn, matches = calculate_matches(descriptors_1, descriptors_2)
-    if debug:
-        save_matches_image(image_1_cv, keypoints_1, image_2_cv, keypoints_2, matches, "err1.jpg")
-    matches = clear_matches(knn, keypoints_1, keypoints_2, matches, height, time_difference)
-    if debug:
-        save_matches_image(image_1_cv, keypoints_1, image_2_cv, keypoints_2, matches, "err2.jpg")
-    
-    
-    
-    
-    
-    if len(matches) < 20:
-        raise ValueError(f"Too few matches ({len(matches)}).")
+    # image 2 of the previous pair is image 1 now, so it comes from the store
+    frame_1, frame_2 = load_pair(load_frame, (image_1, nfeatures), (image_2, nfeatures), tiles, scale=scale, roi=roi)
+    return speed_from_frames(frame_1, frame_2, time, time_difference, orbit_state._replace(height=height),
+                             image_2, matcher, scale, debug)
 
-    # --- Build matched point arrays
-    pts1 = np.float32([keypoints_1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    pts2 = np.float32([keypoints_2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
 
-    # --- Robustly estimate motion and keep only inliers
-    # Affine partial: translation + rotation + scale (good for small viewpoint changes)
-    M, inliers = cv2.estimateAffinePartial2D(
-        pts1, pts2, method=cv2.RANSAC, ransacReprojThreshold=3.0, maxIters=2000
+def run_shots(
+    shot_1,
+    shot_2,
+    key_1: str,
+    key_2: str,
+    nfeatures: int = 4000,
+    height: float | None = None,
+    debug: bool = False,
+    matcher: str = "bf",
+    scale: float = 1.0,
+    roi: bool = False,
+    tiles: tuple[int, int] | None = None,
+    phase: bool = True,
+):
+    """
+    run() on two frames still in memory (camera.Shot), before their JPEGs
+    are written. The capture times come from the shots, key_1/key_2 (the
+    file names the photos will get) identify the frames in FEATURE_STORE.
+    """
+    print("running exif on frames: ", key_1, key_2)
+    time_difference = shot_2.time - shot_1.time
+    if time_difference <= 0:
+        raise ValueError("Time difference is zero or negative.")
+    orbit_state = calc.get_orbit_state(shot_1.time, height=height)
+
+    if phase and (speed_kmps := phase_speed(shot_1.gray, shot_2.gray, shot_1.time, time_difference,
+                                            orbit_state)) is not None:
+        print(f"image: {key_2}, speed: {speed_kmps:.03f} km/s (phase correlation)")
+        return speed_kmps, [speed_kmps]
+
+    frame_1, frame_2 = load_pair(load_array, (key_1, shot_1.gray, nfeatures), (key_2, shot_2.gray, nfeatures),
+                                 tiles, scale=scale, roi=roi)
+    return speed_from_frames(frame_1, frame_2, shot_1.time, time_difference, orbit_state,
+                             key_2, matcher, scale, debug)
+
+
+def speed_from_frames(frame_1: Frame, frame_2: Frame, time, time_difference: float, orbit_state: calc.OrbitState,
+                      label: str = "", matcher: str = "bf", scale: float = 1.0, debug: bool = False):
+    """The part of run() after the frames are loaded, returns (speed_kmps, speeds)"""
+    inlier_matches, pts1, pts2 = match_frames(
+        frame_1, frame_2, time, time_difference, orbit_state, matcher, scale, debug
     )
-    if inliers is None:
-        raise ValueError("RANSAC failed (no inliers).")
 
-    inlier_matches = [m for m, good in zip(matches, inliers.ravel()) if good]
-    
-    speeds: list[float] = []
-    for m in inlier_matches:
-        p1 = keypoints_1[m.queryIdx].pt
-        p2 = keypoints_2[m.trainIdx].pt
-
-        speed = calc.get_speed(p1, p2, time, time_difference)
-        if speed >= calc.MIN_SPEED/1000 and speed <= 2*7.6 - calc.MIN_SPEED/1000:   # if bad speed caused by picture err dont append
-            speeds.append(speed)
-    
+    with span("get_speeds"):
+        all_speeds = calc.get_speeds(pts1, pts2, time, time_difference, state=orbit_state)
+    speeds: list[float] = all_speeds[calc.speed_mask(all_speeds)].tolist()   # if bad speed caused by picture err drop it
+
     if len(speeds) == 0:
         raise ValueError(f"Exif failed, output out of expected range")
 
-    speed_kmps, std = calc.do_statistik(speeds)
+    with span("do_statistik"):
+        speed_kmps, std = calc.do_statistik(speeds)
 
     if (speed_kmps < 7 or speed_kmps > 8.5) and debug:
-        save_matches_image(image_1_cv, keypoints_1, image_2_cv, keypoints_2, inlier_matches, f"time={time:.00f}speed{speed_kmps:.03f}.jpg") 
-    print(f"image: {image_2}, speed: {speed_kmps:.03f} +- {std:.03f} km/s")
+        save_matches_image(frame_1.gray, frame_1.keypoints, frame_2.gray, frame_2.keypoints, inlier_matches, f"time={time:.00f}speed{speed_kmps:.03f}.jpg") 
+    print(f"image: {label}, speed: {speed_kmps:.03f} +- {std:.03f} km/s")
     return speed_kmps, speeds
 
 
@@ -301,9 +880,21 @@ def _cli():
     p.add_argument("--gsd", type=float, default=None, help="Ground sample distance (cm per pixel)")
     p.add_argument("--nfeatures", type=int, default=4000)
     p.add_argument("--save-matches", default=None, help="Write match image to this path (no GUI needed)")
+    p.add_argument("--matcher", choices=list(MATCHERS), default="bf",
+                   help="bf: brute force, flann: FLANN LSH index, guided: only near the expected ISS shift")
+    p.add_argument("--scale", type=float, default=1.0,
+                   help="Detect features at this fraction of the full resolution, matches are refined at full resolution")
+    p.add_argument("--tiles", type=int, nargs=2, default=None, metavar=("COLS", "ROWS"),
+                   help="Detect ORB per tile in a thread pool, both frames at once")
+    p.add_argument("--roi", action="store_true",
+                   help="Only detect features in the textured, well exposed part of the frame")
+    p.add_argument("--no-phase", action="store_true",
+                   help="Skip the phase correlation tier, always match features")
     args = p.parse_args()
 
-    speed = run(args.image1, args.image2, gsdnapix=args.gsd, nfeatures=args.nfeatures, save_matches=args.save_matches)
+    speed = run(args.image1, args.image2, gsdnapix=args.gsd, nfeatures=args.nfeatures,
+                save_matches=args.save_matches, matcher=args.matcher, scale=args.scale, roi=args.roi,
+                tiles=tuple(args.tiles) if args.tiles else None, phase=not args.no_phase)
     print(speed)
 
 
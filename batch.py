@@ -0,0 +1,197 @@
+# batch.py
+"""
+Offline processing of a whole images/ directory from fotak.take_photo.
+
+Frames are ordered by the timestamp in their file name (the EXIF capture
+time for names without one, see exiftime.py) and every
+consecutive pair (plus skip-1/skip-2 pairs with --skip 1 2) is run through
+EXIF.run in a process pool. Each worker gets a contiguous run of pairs,
+so neighbouring pairs share decoded features through EXIF.FEATURE_STORE.
+
+    python batch.py images/ --skip 1 --csv pairs.csv --json run.json
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timezone
+from pathlib import Path
+
+import numpy as np
+
+from exiftime import read_time, scan_directory
+
+
+def _name_time(path: str | Path) -> float | None:
+    # prefix_1234567890.123.jpg -> 1234567890.123
+    try:
+        return float(Path(path).stem.split("_")[-1])
+    except ValueError:
+        return None
+
+
+def frame_time(path: str | Path) -> float | None:
+    """Unix capture time from the file name, else from the EXIF header"""
+    name_time = _name_time(path)
+    if name_time is not None:
+        return name_time
+    try:
+        # naive EXIF times are UTC, camera.encode_jpeg writes them so and orbit.get_time reads them so
+        return read_time(path).replace(tzinfo=timezone.utc).timestamp()
+    except (OSError, ValueError):
+        return None
+
+
+def list_frames(directory: str | Path, prefix: str = "image") -> list[Path]:
+    """Frames of one run, in capture order"""
+    from fotak import read_manifest
+
+    # fotak keeps a manifest of what it saved, no need to glob and parse the names
+    records = read_manifest(directory, prefix)
+    if records:
+        return [p for p in (Path(directory) / r.path for r in records) if p.exists()]
+
+    paths = list(Path(directory).glob(f"{prefix}_*.jpg"))
+    if any(_name_time(p) is None for p in paths):
+        # read all the EXIF headers in one directory pass, frame_time() then hits the cache
+        scan_directory(directory, f"{prefix}_*.jpg")
+    frames = [p for p in paths if frame_time(p) is not None]
+    return sorted(frames, key=frame_time)
+
+
+def make_pairs(n_frames: int, skips: tuple[int, ...] = ()) -> list[tuple[int, int]]:
+    """(i, j) frame index pairs: all consecutive ones, plus j = i + 1 + skip"""
+    gaps = sorted({1} | {1 + s for s in skips if s > 0})
+    return sorted((i, i + gap) for gap in gaps for i in range(n_frames - gap))
+
+
+def _chunks(pairs: list[tuple[int, int]], n: int) -> list[list[tuple[int, int]]]:
+    # contiguous runs of pairs, so the frames of a run are decoded once per worker
+    n = max(1, min(n, len(pairs)))
+    return [list(c) for c in np.array_split(np.array(pairs, dtype=int), n) if len(c)]
+
+
+def _process_chunk(frames: list[str], pairs: list[tuple[int, int]], options: dict,
+                   feature_cache: str | None = None) -> list[dict]:
+    # runs in a worker process, heavy imports happen once per process
+    import EXIF
+    from features import DiskFeatureStore
+    from orbit import prepare_ephemeris
+
+    if feature_cache is not None:
+        EXIF.DISK_STORE = DiskFeatureStore(feature_cache)
+
+    max_gap = max(j - i for i, j in pairs)
+    EXIF.FEATURE_STORE.maxsize = max(EXIF.FEATURE_STORE.maxsize, max_gap + 2)
+
+    times = [frame_time(frames[k]) for pair in pairs for k in pair]
+    prepare_ephemeris(min(times) - 120, max(times) - min(times) + 240)
+
+    results = []
+    for i, j in pairs:
+        result = {"image_1": frames[i], "image_2": frames[j], "gap": j - i,
+                  "time_difference": frame_time(frames[j]) - frame_time(frames[i]),
+                  "speed": None, "std": None, "n_speeds": 0, "tier": None, "matches": None, "inliers": None,
+                  "error": None}
+        try:
+            speed, speeds = EXIF.run(frames[i], frames[j], **options)
+            result.update(speed=float(speed), std=float(np.std(speeds)), n_speeds=len(speeds), tier=EXIF.last.tier)
+            # phase correlation or ORB, only the latter has match counts
+            if EXIF.last.quality is not None:
+                result.update(matches=EXIF.last.quality.matches, inliers=EXIF.last.quality.inliers)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        results.append(result)
+    return results
+
+
+def process_directory(directory: str | Path, prefix: str = "image", skips: tuple[int, ...] = (),
+                      workers: int | None = None, feature_cache: str | Path | None = None,
+                      **options) -> list[dict]:
+    """
+    Per-pair results for a whole directory, options are passed to EXIF.run.
+    With `feature_cache` the keypoints are kept in that directory, so running
+    again over the same photos (other matcher, skips...) skips ORB.
+    """
+    frames = [str(p) for p in list_frames(directory, prefix)]
+    pairs = make_pairs(len(frames), skips)
+    if not pairs:
+        return []
+
+    workers = workers or os.cpu_count() or 1
+    results: list[dict] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_process_chunk, frames, [tuple(map(int, p)) for p in chunk], options,
+                               None if feature_cache is None else str(feature_cache))
+                   for chunk in _chunks(pairs, workers)]
+        for future in futures:
+            results += future.result()
+    return sorted(results, key=lambda r: (frame_time(r["image_1"]), r["gap"]))
+
+
+def aggregate(results: list[dict]) -> dict:
+    import calc
+
+    summary = {"pairs": len(results), "failed": sum(r["speed"] is None for r in results)}
+    for gap in sorted({r["gap"] for r in results}) + [None]:
+        speeds = [r["speed"] for r in results if r["speed"] is not None and (gap is None or r["gap"] == gap)]
+        if len(speeds) > 1:
+            speed, std = calc.do_statistik(speeds)
+        elif speeds:
+            speed, std = speeds[0], 0.0
+        else:
+            speed, std = None, None
+        key = "all" if gap is None else f"gap_{gap}"
+        summary[key] = {"speed": None if speed is None else float(speed),
+                        "std": None if std is None else float(std), "n": len(speeds)}
+    return summary
+
+
+def write_csv(results: list[dict], path: str | Path) -> None:
+    fields = ["image_1", "image_2", "gap", "time_difference", "speed", "std", "n_speeds", "tier", "matches", "inliers",
+              "error"]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def write_json(results: list[dict], summary: dict, path: str | Path) -> None:
+    with open(path, "w") as f:
+        json.dump({"summary": summary, "pairs": results}, f, indent=2)
+
+
+def _cli():
+    p = argparse.ArgumentParser(description="Compute the ISS speed for every photo pair in a directory")
+    p.add_argument("directory")
+    p.add_argument("--prefix", default="image", help="File name prefix used by fotak.take_photo")
+    p.add_argument("--skip", type=int, nargs="*", default=[], help="Also pair frame i with i+1+SKIP")
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--nfeatures", type=int, default=4000)
+    p.add_argument("--matcher", default="bf")
+    p.add_argument("--scale", type=float, default=1.0)
+    p.add_argument("--roi", action="store_true")
+    p.add_argument("--tiles", type=int, nargs=2, default=None, metavar=("COLS", "ROWS"))
+    p.add_argument("--no-phase", action="store_true", help="Always match features, no phase correlation tier")
+    p.add_argument("--feature-cache", default=None, metavar="DIR",
+                   help="Keep keypoints and descriptors here, reruns skip feature detection")
+    p.add_argument("--csv", default=None, help="Write per-pair results to this CSV file")
+    p.add_argument("--json", default=None, help="Write per-pair results and the summary to this JSON file")
+    args = p.parse_args()
+
+    results = process_directory(args.directory, args.prefix, tuple(args.skip), args.workers, args.feature_cache,
+                                nfeatures=args.nfeatures, matcher=args.matcher, scale=args.scale, roi=args.roi,
+                                tiles=tuple(args.tiles) if args.tiles else None, phase=not args.no_phase)
+    summary = aggregate(results)
+    if args.csv:
+        write_csv(results, args.csv)
+    if args.json:
+        write_json(results, summary, args.json)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    _cli()
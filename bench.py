@@ -0,0 +1,261 @@
+# bench.py
+"""
+Benchmark of the speed estimation pipeline on synthetic frame pairs.
+
+Every pair is a random ground texture and a copy of it moved by a known
+translation + rotation, so the true speed is known and each run reports
+accuracy next to the stage timings. Each pair goes through EXIF.run
+itself, with the orbit fixed, and the stage times come from its profiling
+spans. Every configuration runs once with the phase correlation tier
+first (the default of EXIF.run) and once ORB only.
+
+    python bench.py --nfeatures 1000 2000 4000 --scales 1.0 0.5 --matchers bf guided --tiles 4 3
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import resource
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import calc
+import EXIF
+import profiling
+from camera import encode_jpeg, ground_texture
+
+INTERVAL = 14.5     # s between the two synthetic photos
+HEIGHT = 420000     # m
+# a fixed orbit, so no Skyfield propagation is needed
+_radius = calc.get_radius(0.3, calc.EARTH_WIDTH, calc.EARTH_HEIGHT)
+BENCH_STATE = calc.OrbitState(lat=0.7, lon=0.3, azimuth=1.0, height=HEIGHT,
+                              radius=_radius, orbital_radius=_radius + HEIGHT)
+
+STAGES = ["total", "phase", "decode", "resize", "roi", "_prep", "orb", "matching", "filtering",
+          "refine", "ransac", "get_speeds", "do_statistik"]
+T0 = 1.7e9          # unix time of the first synthetic photo
+
+
+def synthetic_pair(resolution: tuple[int, int] = calc.CAM_RESOLUTION, shift: tuple[float, float] = (-740.0, 30.0),
+                   rotation_deg: float = 0.05, noise: float = 3.0, seed: int = 0):
+    """
+    Two frames of the same ground, the second one moved so a point p of
+    image 1 shows up at A @ p in image 2. Returns (image_1, image_2, A).
+    """
+    w, h = resolution
+    margin = int(max(abs(shift[0]), abs(shift[1]))) + 64
+    world = ground_texture((h + 2*margin, w + 2*margin), seed)
+    image_1 = world[margin:margin + h, margin:margin + w].copy()
+
+    # image 1 -> image 2: rotate around the centre, then translate
+    A = cv2.getRotationMatrix2D((w / 2, h / 2), rotation_deg, 1.0)
+    A[:, 2] += shift
+    # image 2 pixel -> world pixel, for the inverse warp
+    B = cv2.invertAffineTransform(A)
+    B[:, 2] += margin
+    image_2 = cv2.warpAffine(world, B, (w, h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+    rng = np.random.default_rng(seed + 1)
+    image_2 = np.clip(image_2 + rng.normal(0, noise, image_2.shape), 0, 255).astype(np.uint8)
+    return image_1, image_2, A
+
+
+def _ground_points(points, resolution: tuple[int, int], state: calc.OrbitState) -> np.ndarray:
+    # ray through each pixel from the ISS, intersected with the Earth sphere (Earth centre at 0)
+    w, h = resolution
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    rays = np.column_stack(((points[:, 0] - (w - 1) / 2) * calc.SENSOR_DIM[0] / w,
+                            (points[:, 1] - (h - 1) / 2) * calc.SENSOR_DIM[1] / h,
+                            np.full(len(points), -calc.FOCUS_LENGTH)))
+    rays /= np.linalg.norm(rays, axis=1)[:, None]
+    iss = np.array([0.0, 0.0, state.orbital_radius])
+    b = rays @ iss
+    t = -b - np.sqrt(b * b - (state.orbital_radius ** 2 - state.radius ** 2))   # the near intersection
+    return iss + t[:, None] * rays
+
+
+def true_speed(A, resolution: tuple[int, int], time_diff: float = INTERVAL, state: calc.OrbitState = BENCH_STATE,
+               points=None) -> float:
+    """
+    Ground speed of the synthetic motion at `points` (image 1 pixels, the
+    image centre if None), projected onto the sphere independently of
+    calc.CameraModel. The synthetic shift is the same everywhere in pixels,
+    which is a different ground speed at every point, so errors are measured
+    at the matched points. Combined with the orbit like calc.get_speeds, but
+    not gated by calc.speed_mask: this is the truth, whatever its value.
+    """
+    if points is None:
+        points = np.array([[(resolution[0] - 1) / 2, (resolution[1] - 1) / 2]])
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    moved = points @ A[:, :2].T + A[:, 2]
+    g1, g2 = _ground_points(points, resolution, state), _ground_points(moved, resolution, state)
+    angle = np.arctan2(np.linalg.norm(np.cross(g1, g2), axis=1), np.einsum("ij,ij->i", g1, g2))
+
+    ang_speed = angle / time_diff
+    north = ang_speed * np.sin(state.azimuth)
+    east = ang_speed * np.cos(state.azimuth) + calc.EARTH_ROTATION_SPEED * np.cos(state.lat)
+    speeds = np.hypot(north, east) * state.orbital_radius / 1000
+    # aggregated like the measurement (the 2 sigma clip of do_statistik), never gated
+    return float(calc.do_statistik(speeds)[0]) if len(speeds) > 1 else float(speeds[0])
+
+
+def bench_pair(path_1: Path, path_2: Path, nfeatures: int = 4000, scale: float = 1.0, matcher: str = "bf",
+               roi: bool = False, tiles: tuple[int, int] | None = None, phase: bool = True):
+    """
+    EXIF.run on one pair with the orbit fixed to BENCH_STATE, timed per stage
+    with profiling.collect(). Returns (speed km/s, {stage: seconds}, (N, 2)
+    image 1 inlier points, RANSAC inliers); both None if the phase tier
+    measured the pair. EXIF.run's own errors (ValueError) are passed on.
+    """
+    with profiling.collect() as stages, redirect_stdout(io.StringIO()):     # EXIF.run's progress lines
+        start = time.perf_counter()
+        speed, _ = EXIF.run(str(path_1), str(path_2), nfeatures=nfeatures, orbit_state=BENCH_STATE,
+                            matcher=matcher, scale=scale, roi=roi, tiles=tiles, phase=phase)
+        stages["total"] = time.perf_counter() - start
+    if EXIF.last.tier == "phase":
+        return float(speed), stages, None, None
+    return float(speed), stages, EXIF.last.matched.pts1.reshape(-1, 2), EXIF.last.quality.inliers
+
+
+def bench_config(pairs, nfeatures: int, scale: float, matcher: str, roi: bool, resolution,
+                 tiles: tuple[int, int] | None = None, phase: bool = True) -> dict:
+    times: dict[str, list[float]] = defaultdict(list)
+    errors: list[float] = []
+    inliers: list[int] = []
+    failures = 0
+    phase_pairs = 0
+
+    # every configuration starts cold: no cached frames, no motion or heading from an earlier one
+    EXIF.FEATURE_STORE.clear()
+    EXIF.MOTION_MODEL.reset()
+    EXIF.LAST_VELOCITY.reset()
+    disk_store, EXIF.DISK_STORE = EXIF.DISK_STORE, None
+    camera, calc.CAMERA = calc.CAMERA, calc.CameraModel(tuple(resolution))
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        for path_1, path_2, A in pairs:
+            try:
+                speed, stages, points, n = bench_pair(path_1, path_2, nfeatures, scale, matcher, roi, tiles, phase)
+            except ValueError as e:
+                print(f"  failed: {e}")
+                failures += 1
+                continue
+            for name, seconds in stages.items():
+                times[name].append(seconds)
+            # phase_speed measures the frame centre (points None)
+            errors.append(speed - true_speed(A, resolution, points=points))
+            if n is None:
+                phase_pairs += 1
+            else:
+                inliers.append(n)
+    finally:
+        EXIF.DISK_STORE, calc.CAMERA = disk_store, camera
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+
+    errors_a = np.array(errors) if errors else np.array([np.nan])
+    order = STAGES + sorted(set(times) - set(STAGES))
+    return {
+        "nfeatures": nfeatures,
+        "scale": scale,
+        "matcher": matcher,
+        "roi": roi,
+        "tiles": list(tiles) if tiles is not None else None,
+        "phase": phase,
+        "pairs": len(pairs),
+        "phase_pairs": phase_pairs,
+        "failures": failures,
+        "pairs_per_s": len(pairs) / elapsed,
+        # mean over the pairs that went through the stage; with tiles both frames are detected
+        # at the same time, so their decode and orb can add up to more than the total
+        "stage_ms": {name: 1000 * float(np.mean(times[name])) for name in order if name in times},
+        "peak_traced_mb": peak / 2**20 if peak is not None else None,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "inliers": float(np.mean(inliers)) if inliers else 0.0,
+        "bias_kmps": float(np.mean(errors_a)),
+        "rms_error_kmps": float(np.sqrt(np.mean(errors_a ** 2))),
+    }
+
+
+def _memory(r: dict) -> str:
+    if r["peak_traced_mb"] is None:
+        return f"max rss {r['max_rss_mb']:.0f} MB"
+    return f"peak {r['peak_traced_mb']:.0f} MB (max rss {r['max_rss_mb']:.0f} MB)"
+
+
+def print_result(r: dict) -> None:
+    tiles = "x".join(map(str, r["tiles"])) if r["tiles"] else "-"
+    print(f"nfeatures={r['nfeatures']:<6} scale={r['scale']:<5} matcher={r['matcher']:<7} roi={r['roi']!s:<5} "
+          f"tiles={tiles:<5} phase={r['phase']!s:<5} "
+          f"{r['pairs_per_s']:.3f} pairs/s  {_memory(r)}  "
+          f"inliers {r['inliers']:.0f}  error {r['bias_kmps']:+.4f} (rms {r['rms_error_kmps']:.4f}) km/s  "
+          f"by phase {r['phase_pairs']}/{r['pairs']}  failed {r['failures']}/{r['pairs']}")
+    print("    " + "  ".join(f"{name} {ms:.1f}" for name, ms in r["stage_ms"].items()) + "  [ms]")
+
+
+def _cli():
+    p = argparse.ArgumentParser(description="Time and check the speed pipeline on synthetic frame pairs")
+    p.add_argument("--pairs", type=int, default=3, help="Synthetic pairs per configuration")
+    p.add_argument("--resolution", type=int, nargs=2, default=list(calc.CAM_RESOLUTION), metavar=("W", "H"))
+    p.add_argument("--nfeatures", type=int, nargs="+", default=[1000, 2000, 4000])
+    p.add_argument("--scales", type=float, nargs="+", default=[1.0, 0.5])
+    p.add_argument("--matchers", nargs="+", choices=list(EXIF.MATCHERS), default=["bf"])
+    p.add_argument("--roi", action="store_true", help="Also run every configuration with the ROI mask")
+    p.add_argument("--tiles", type=int, nargs=2, default=None, metavar=("COLS", "ROWS"),
+                   help="Also run every configuration with tiled ORB detection")
+    p.add_argument("--no-phase", action="store_true",
+                   help="Only the ORB tier, skip the configurations with phase correlation first")
+    p.add_argument("--shift", type=float, nargs=2, default=None, metavar=("DX", "DY"),
+                   help="Ground motion between the photos in pixels, -740 30 at full resolution by default")
+    p.add_argument("--rotation", type=float, default=0.05, help="Rotation between the photos in degrees")
+    p.add_argument("--trace-memory", action="store_true",
+                   help="Peak Python/numpy memory per configuration via tracemalloc (slows small numpy ops down)")
+    p.add_argument("--json", default=None, help="Also write all results to this file")
+    args = p.parse_args()
+    resolution = tuple(args.resolution)
+    # the same ground speed at any resolution
+    shift = tuple(args.shift) if args.shift else (-740.0 * resolution[0] / calc.CAM_RESOLUTION[0],
+                                                  30.0 * resolution[0] / calc.CAM_RESOLUTION[0])
+
+    if args.trace_memory:
+        tracemalloc.start()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        pairs = []
+        for i in range(args.pairs):
+            image_1, image_2, A = synthetic_pair(resolution, shift, args.rotation, seed=i)
+            # JPEGs named and tagged like fotak.take_frame's, so EXIF.run reads them as on the Pi
+            taken = T0 + 100 * i
+            path_1, path_2 = Path(tmp) / f"bench_{taken:.03f}.jpg", Path(tmp) / f"bench_{taken + INTERVAL:.03f}.jpg"
+            path_1.write_bytes(encode_jpeg(image_1, taken))
+            path_2.write_bytes(encode_jpeg(image_2, taken + INTERVAL))
+            pairs.append((path_1, path_2, A))
+        print(f"{args.pairs} pairs at {resolution[0]}x{resolution[1]}, true speed {true_speed(pairs[0][2], resolution):.3f} km/s at the centre")
+
+        for nfeatures in args.nfeatures:
+            for scale in args.scales:
+                for matcher in args.matchers:
+                    for roi in ([False, True] if args.roi else [False]):
+                        for tiles in ([None, tuple(args.tiles)] if args.tiles else [None]):
+                            for phase in ([False] if args.no_phase else [True, False]):
+                                result = bench_config(pairs, nfeatures, scale, matcher, roi, resolution, tiles, phase)
+                                print_result(result)
+                                results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    _cli()
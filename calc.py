@@ -1,12 +1,17 @@
 import math
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from typing import NamedTuple
 from orbit import get_height_at, get_azimut, get_pos, get_height  # , get_speed_approx
 import numpy as np
+from profiling import timed
 # set it correctly
 CAM_RESOLUTION= (4056, 3040)
 SENSOR_DIM = (0.006287, 0.004712)
 EARTH_RADIUS = 6371008.8 # m
 FOCUS_LENGTH = 0.005 # m
 MIN_SPEED = 6000    # m/s
+MAX_SPEED = 2*7600 - MIN_SPEED    # m/s, as far above the ~7.6 km/s orbit as MIN_SPEED is below
 EARTH_HEIGHT = 6356752
 EARTH_WIDTH = 6378137
 EARTH_ROTATION_SPEED = 7.2921150e-5  # rad/s
@@ -14,6 +19,86 @@ EARTH_ROTATION_SPEED = 7.2921150e-5  # rad/s
 Position = tuple[float, float]
 
 
+class OrbitState(NamedTuple):
+    """Where the ISS is at one timestamp, everything get_speeds needs from orbit.py"""
+    lat: float              # radians
+    lon: float              # radians
+    azimuth: float          # radians
+    height: float           # meters above Earth
+    radius: float           # Earth radius below the ISS, meters
+    orbital_radius: float   # radius + height, meters
+
+
+class CameraModel:
+    """
+    Pinhole camera looking straight down, with the pixel -> view angle
+    lookup built once. A pixel is its distance r from the optical centre
+    (on the sensor) plus an azimuth; view_angle[i] is the angle from the
+    optical axis at r = i * radius_step, in between it is interpolated.
+
+    ground_points() puts pixels on the Earth sphere, as the central angle
+    phi(theta) = arcsin(k * sin(theta)) - theta from the point below the
+    ISS (k = orbital radius / radius) in the pixel's azimuth, and
+    ground_angles() is the great circle angle between two of them. So every
+    match gets the curvature and GSD of its own place in the frame.
+    """
+
+    def __init__(self, resolution: tuple[int, int] = CAM_RESOLUTION, sensor_dim: tuple[float, float] = SENSOR_DIM,
+                 focus_length: float = FOCUS_LENGTH):
+        self.resolution = resolution
+        self.focus_length = focus_length
+        w, h = resolution
+        self.pixel_pitch = (sensor_dim[0] / w, sensor_dim[1] / h)
+        self.center = ((w - 1) / 2, (h - 1) / 2)    # pixel centres are at integer positions
+        # one table entry per pixel of radius, out to the corners
+        self.radius_step = min(self.pixel_pitch)
+        n = math.ceil(math.hypot(*sensor_dim) / 2 / self.radius_step) + 2
+        self.view_angle = np.arctan(np.arange(n) * self.radius_step / focus_length)
+        self.view_step = np.diff(self.view_angle)
+
+    def _view(self, pts) -> tuple[np.ndarray, np.ndarray]:
+        # (view angle from the optical axis, azimuth on the sensor) of pixel positions
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        sx = (pts[:, 0] - self.center[0]) * self.pixel_pitch[0]
+        sy = (pts[:, 1] - self.center[1]) * self.pixel_pitch[1]
+        r = np.hypot(sx, sy) / self.radius_step
+        i = np.minimum(r.astype(np.intp), len(self.view_step) - 1)
+        theta = self.view_angle[i] + (r - i) * self.view_step[i]
+        # far outside the frame (extrapolated points) compute it, the table doesn't reach
+        outside = r > len(self.view_step)
+        if outside.any():
+            theta[outside] = np.arctan(r[outside] * self.radius_step / self.focus_length)
+        return theta, np.arctan2(sy, sx)
+
+    def ground_points(self, pts, state: OrbitState) -> np.ndarray:
+        """(N, 3) unit vectors from the Earth centre to the ground seen at the pixel positions `pts`"""
+        theta, azimuth = self._view(pts)
+        phi = np.arcsin(np.sin(theta) * state.orbital_radius / state.radius) - theta
+        sin_phi = np.sin(phi)
+        return np.column_stack((sin_phi * np.cos(azimuth), sin_phi * np.sin(azimuth), np.cos(phi)))
+
+    def ground_angles(self, pts1, pts2, state: OrbitState) -> np.ndarray:
+        """(N,) great circle angles in radians between the ground seen at pts1 and at pts2"""
+        chord = np.linalg.norm(self.ground_points(pts1, state) - self.ground_points(pts2, state), axis=1)
+        return 2 * np.arcsin(np.minimum(chord / 2, 1.0))
+
+    def gsd(self, pts, state: OrbitState) -> np.ndarray:
+        """
+        (N, 2) ground sample distance in m/px (x, y) at the pixel positions
+        `pts`, get_GSD() under the ISS, about 5% coarser in the corners
+        """
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        gsd = np.empty_like(pts)
+        for axis in (0, 1):
+            half = np.zeros(2)
+            half[axis] = 0.5
+            gsd[:, axis] = self.ground_angles(pts + half, pts - half, state) * state.radius
+        return gsd
+
+
+# built once, get_speeds() uses it unless given another camera
+CAMERA = CameraModel()
+
 
 def get_GSD(height: float) -> tuple[float, float]:
     return height*SENSOR_DIM[0]/CAM_RESOLUTION[0]/FOCUS_LENGTH, height*SENSOR_DIM[1]/CAM_RESOLUTION[1]/FOCUS_LENGTH
@@ -80,12 +165,89 @@ def get_radius(lon: float, width: float, height: float):
 
 
 def do_statistik(data: list[float]):
+    data = np.asarray(data, dtype=np.float64)
     mean = np.mean(data)
     std = np.std(data)
-    filtered: list[float] = [d for d in data if (d > mean - 2*std) & (d < mean + 2*std)]
+    filtered = data[(data > mean - 2*std) & (data < mean + 2*std)]
     mean_filtered: float = np.mean(filtered)
     return mean_filtered, std
 
+
+class RunningStats:
+    """
+    Streaming do_statistik over the last `window` samples.
+
+    add() is O(log n): Welford mean/variance (with removal once the window is
+    full) plus a sorted copy for the median and the 2 sigma clip. estimate()
+    gives the same (clipped mean, std) as do_statistik on the window, the sum of
+    the clipped samples is the running sum minus the few rejected ones.
+    If the clip rejects everything (all samples equal) the plain mean is returned.
+    """
+
+    def __init__(self, window: int = 256):
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.window = window
+        self._samples: deque[float] = deque()
+        self._sorted: list[float] = []
+        self._sum = 0.0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.seen = 0   # all samples ever added
+
+    def add(self, x: float) -> None:
+        x = float(x)
+        if len(self._samples) == self.window:
+            self._remove(self._samples.popleft())
+        self._samples.append(x)
+        insort(self._sorted, x)
+        self._sum += x
+        self.seen += 1
+
+        delta = x - self.mean
+        self.mean += delta / len(self._samples)
+        self._m2 += delta * (x - self.mean)
+
+    def _remove(self, x: float) -> None:
+        del self._sorted[bisect_left(self._sorted, x)]
+        self._sum -= x
+        n = len(self._samples)   # x already left the deque
+        if n == 0:
+            self.mean = self._m2 = self._sum = 0.0
+            return
+        old_mean = self.mean
+        self.mean = (old_mean * (n + 1) - x) / n
+        self._m2 -= (x - old_mean) * (x - self.mean)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    @property
+    def std(self) -> float:
+        if not self._samples:
+            return 0.0
+        return math.sqrt(max(self._m2, 0.0) / len(self._samples))
+
+    def median(self) -> float:
+        values = self._sorted
+        n = len(values)
+        if n == 0:
+            raise ValueError("No samples yet.")
+        mid = n // 2
+        return values[mid] if n % 2 else (values[mid - 1] + values[mid]) / 2
+
+    def estimate(self) -> tuple[float, float]:
+        """(2 sigma clipped mean, std) of the window, like do_statistik"""
+        if not self._samples:
+            raise ValueError("No samples yet.")
+        mean, std = self.mean, self.std
+        lo = bisect_right(self._sorted, mean - 2*std)
+        hi = bisect_left(self._sorted, mean + 2*std)
+        if hi <= lo:
+            return mean, std
+        inside = self._sum - math.fsum(self._sorted[:lo]) - math.fsum(self._sorted[hi:])
+        return inside / (hi - lo), std
+
 def rotate_azimuth(length, beta_rad):
     """
     Rotate a 2D vector [0, length] clockwise by beta_rad.
@@ -96,55 +258,80 @@ def rotate_azimuth(length, beta_rad):
     v = np.array([0.0, length])
     return R @ v
 
-def get_speed(pos1, pos2, time1, df, lat = None, lon = None, azimuth = None, height = None):
+@timed("orbit")
+def get_orbit_state(time1, lat = None, lon = None, azimuth = None, height = None) -> OrbitState:
     """
-    Compute total linear speed in km/s from two image positions.
-
-    pos1, pos2 : pixel positions (x, y)
-    time1      : timestamp of first image (s)
-    df         : time difference between images (s)
-    lat, lon   : radians
-    azimuth    : radians
-    height     : meters above Earth
+    Snapshot of the orbit at time1, only the values not given are looked up.
+    Each lookup is a full ISS propagation, so compute this once per frame
+    and pass it around instead of the separate values.
     """
     if lat is None or lon is None:
         lat, lon = get_pos(time1)
-    
+
     if azimuth is None:
         azimuth = get_azimut(time1)
-    
+
     if height is None:
         height = get_height_at(time1)
 
     radius = get_radius(lon, EARTH_WIDTH, EARTH_HEIGHT)
-    orbital_radius = radius + height  # meters
-
-    # 1. Pixel displacement to sensor displacement
-    dx = pos1[0] - pos2[0]
-    dy = pos1[1] - pos2[1]
-    # print("dx, dy", dx, dy)
-    sensor_dx = dx * SENSOR_DIM[0] / CAM_RESOLUTION[0]
-    sensor_dy = dy * SENSOR_DIM[1] / CAM_RESOLUTION[1]
-
-    # 2. Angular displacement in radians
-    angle_x = np.arctan2(sensor_dx, FOCUS_LENGTH)
-    angle_y = np.arctan2(sensor_dy, FOCUS_LENGTH)
-    angular_disp_cam = np.sqrt(angle_x**2 + angle_y**2)
-    ang_disp_earth = np.arcsin(np.sin(angular_disp_cam)*orbital_radius/radius) - angular_disp_cam
+    return OrbitState(lat, lon, azimuth, height, radius, radius + height)
+
+
+def get_speeds(pts1, pts2, time1, df, lat = None, lon = None, azimuth = None, height = None,
+               state: OrbitState | None = None, camera: CameraModel | None = None) -> np.ndarray:
+    """
+    Vectorised get_speed: total linear speed in km/s for every matched pair.
+
+    pts1, pts2 : (N, 2) arrays of pixel positions (x, y)
+    time1      : timestamp of first image (s)
+    df         : time difference between images (s)
+    lat, lon   : radians
+    azimuth    : radians
+    height     : meters above Earth
+    state      : precomputed get_orbit_state(time1), replaces the four above
+    camera     : CameraModel of the photos, CAMERA by default
+
+    Returns an (N,) array, use speed_mask() to drop implausible values.
+    """
+    if state is None:
+        state = get_orbit_state(time1, lat, lon, azimuth, height)
+
+    if camera is None:
+        camera = CAMERA
+
+    lat, azimuth = state.lat, state.azimuth
+    orbital_radius = state.orbital_radius  # meters
+
+    # 1. + 2. Pixel positions to points on the Earth (lookup table + curvature), the angle between them
+    ang_disp_earth = camera.ground_angles(pts1, pts2, state)
     ang_speed = ang_disp_earth / df  # rad/s
-    # print('ang_speed', ang_speed)
-    # 3. Rotate angular speed vector by azimuth into North/East frame
-    ang_speed_vect = rotate_azimuth(ang_speed, azimuth)  # X = N, Y = E
-    # print('speed vector', ang_speed_vect)
-    # 4. Earth rotation contribution (rad/s) in East direction
-    earth_ang_speed = EARTH_ROTATION_SPEED * np.cos(lat)
-    earth_speed_vect = np.array([0.0, earth_ang_speed])  # X=N, Y=E
-    # print('earth speed vector', earth_speed_vect)
-    # 5. Total angular velocity vector
-    total_ang_vect = ang_speed_vect + earth_speed_vect
-
-    # 6. Convert to linear speed (v = omega * r)
-    total_speed_m_s = np.linalg.norm(total_ang_vect) * orbital_radius
-    # print('total speed', total_speed_m_s)
-    # print('actuall speed', get_speed_approx(time1))
+
+    # 3. Rotate [0, ang_speed] clockwise by azimuth into North/East frame (as rotate_azimuth does)
+    # 4. and add the Earth rotation contribution (rad/s) in East direction
+    north = ang_speed * np.sin(azimuth)
+    east = ang_speed * np.cos(azimuth) + EARTH_ROTATION_SPEED * np.cos(lat)
+
+    # 5. Convert to linear speed (v = omega * r)
+    total_speed_m_s = np.hypot(north, east) * orbital_radius
     return total_speed_m_s / 1000  # km/s
+
+
+def speed_mask(speeds, min_speed: float = MIN_SPEED/1000, max_speed: float = MAX_SPEED/1000) -> np.ndarray:
+    """
+    Boolean mask of the speeds (km/s) inside the plausible range,
+    bad speeds are usually caused by picture errors.
+    """
+    speeds = np.asarray(speeds)
+    return (speeds >= min_speed) & (speeds <= max_speed)
+
+
+def get_speed(pos1, pos2, time1, df, lat = None, lon = None, azimuth = None, height = None,
+              state: OrbitState | None = None):
+    """
+    Compute total linear speed in km/s from two image positions.
+
+    pos1, pos2 : pixel positions (x, y)
+    Thin wrapper around get_speeds, see there for the other arguments.
+    """
+    return float(get_speeds([pos1], [pos2], time1, df, lat, lon, azimuth, height, state)[0])
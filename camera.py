@@ -0,0 +1,171 @@
+# camera.py
+"""
+Camera backends for fotak.take_photo. Everything that needs the Pi camera
+lives here, so the analysis code (EXIF, calc, orbit) imports without it.
+
+    camera = get_camera("pi")               # picamzero, on the Astro Pi
+    camera = get_camera("replay:images/")   # replay the photos of an earlier run
+    camera = get_camera("mock")             # synthetic ground moving under the ISS
+"""
+from __future__ import annotations
+
+import math
+import shutil
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from lazy import LazyModule
+
+cv2 = LazyModule("cv2")
+
+CAM_RESOLUTION = (4056, 3040)
+# unix time of time.monotonic() == 0, shot times are monotonic but comparable to file names/EXIF
+_EPOCH = time.time() - time.monotonic()
+
+
+class Shot(NamedTuple):
+    """One frame straight from the camera, nothing written to disk yet"""
+    image: np.ndarray   # as captured, RGB or grayscale
+    gray: np.ndarray    # what the feature pipeline works on, `image` itself if it is grayscale
+    time: float         # unix seconds, from the monotonic clock
+
+
+def _shot(image, before: float, after: float) -> Shot:
+    # the frame was exposed somewhere inside the capture call
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return Shot(image, gray, _EPOCH + (before + after) / 2)
+
+
+def encode_jpeg(image, taken: float) -> bytes:
+    """
+    JPEG of a captured frame with DateTimeOriginal/SubSecTimeOriginal set to
+    `taken` (unix s), in UTC like the Astro Pi clock: naive EXIF times are
+    read back as UTC everywhere (orbit.get_time, batch.frame_time).
+    """
+    from exif import Image
+
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    ok, jpeg = cv2.imencode(".jpg", image)
+    if not ok:
+        raise RuntimeError("Could not encode the photo.")
+    when = datetime.fromtimestamp(taken, timezone.utc)
+    tagged = Image(jpeg.tobytes())
+    tagged.datetime_original = when.strftime("%Y:%m:%d %H:%M:%S")
+    tagged.subsec_time_original = f"{when.microsecond // 1000:03d}"
+    return tagged.get_file()
+
+
+class PiCamera:
+    """picamzero.Camera, imported only when a real camera is wanted"""
+
+    def __init__(self):
+        try:
+            from picamzero import Camera
+        except ImportError as e:
+            raise ImportError(
+                "Could not import camerazero. Make sure it's installed and you're running on the target device."
+            ) from e
+        self._camera = Camera()
+
+    def take_photo(self, path: str) -> None:
+        self._camera.take_photo(str(path))
+
+    def grab(self) -> Shot:
+        before = time.monotonic()
+        image = self._camera.capture_array()
+        return _shot(image, before, time.monotonic())
+
+
+class ReplayCamera:
+    """Hands out the photos of an earlier run, in capture order"""
+
+    def __init__(self, directory: str | Path, prefix: str = "image"):
+        from batch import list_frames
+
+        self._frames = iter(list_frames(directory, prefix))
+
+    def _next(self) -> Path:
+        try:
+            return next(self._frames)
+        except StopIteration:
+            raise RuntimeError("No photos left to replay.") from None
+
+    def take_photo(self, path: str) -> None:
+        shutil.copyfile(self._next(), path)   # keeps the original EXIF timestamp
+
+    def grab(self) -> Shot:
+        from batch import frame_time
+
+        frame = self._next()
+        gray = cv2.imread(str(frame), 0)
+        if gray is None:
+            raise FileNotFoundError(f"OpenCV could not read {frame}")
+        # the motion in the photos belongs to the original capture times
+        return Shot(gray, gray, frame_time(frame))
+
+
+def ground_texture(shape: tuple[int, int], seed: int = 0):
+    """Multi-octave value noise, looks enough like clouds/terrain for ORB"""
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    img = np.zeros((h, w), np.float32)
+    for octave in range(1, 8):
+        cell = 2 ** octave
+        noise = rng.random((h // cell + 2, w // cell + 2)).astype(np.float32)
+        img += cv2.resize(noise, (w, h), interpolation=cv2.INTER_CUBIC) * math.sqrt(cell)
+    return cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+class MockCamera:
+    """
+    Synthetic ground texture scrolling past at `speed_px` pixels per second,
+    saved as JPEG with a DateTimeOriginal tag like the real camera.
+    """
+
+    def __init__(self, resolution: tuple[int, int] = CAM_RESOLUTION, speed_px: float = 51.0, seed: int = 0):
+        self.resolution = resolution
+        self.speed_px = speed_px
+        w, h = resolution
+        # wide enough for a 10 minute run at 1/4 scale, wraps around after that
+        self._world = ground_texture((h // 4, w // 4 + int(speed_px * 600) // 4), seed)
+        self._start = time.time()
+
+    def capture_array(self):
+        w, h = self.resolution
+        span = self._world.shape[1] * 4 - w
+        offset = (time.time() - self._start) * self.speed_px % span
+        # shift by the exact sub-pixel offset, then upscale the visible window
+        x0 = int(offset // 4)
+        window = self._world[:, x0:x0 + w // 4 + 2]
+        frame = cv2.resize(window, None, fx=4, fy=4, interpolation=cv2.INTER_CUBIC)
+        shift = offset - 4 * x0
+        M = np.float32([[1, 0, -shift], [0, 1, 0]])
+        return cv2.warpAffine(frame, M, (w, h))
+
+    def take_photo(self, path: str) -> None:
+        taken = time.time()
+        jpeg = encode_jpeg(self.capture_array(), taken)
+        with open(path, "wb") as f:
+            f.write(jpeg)
+
+    def grab(self) -> Shot:
+        before = time.monotonic()
+        image = self.capture_array()
+        return _shot(image, before, time.monotonic())
+
+
+def get_camera(spec: str = "pi"):
+    """Camera backend from a spec: "pi", "mock" or "replay:<directory>" """
+    kind, _, arg = spec.partition(":")
+    if kind == "pi":
+        return PiCamera()
+    if kind == "mock":
+        return MockCamera()
+    if kind == "replay":
+        return ReplayCamera(arg or "images/")
+    raise ValueError(f"Unknown camera {spec!r}, use pi, mock or replay:<directory>.")
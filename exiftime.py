@@ -0,0 +1,159 @@
+# exiftime.py
+"""
+Capture time of a JPEG straight from its EXIF header.
+
+Only the APP1 segment is read: the markers before it are skipped with a
+seek, and the two tags needed, DateTimeOriginal and SubSecTimeOriginal,
+are looked up in the TIFF directories. No image data is touched and no
+exif.Image is built. Results are cached per file (path, mtime, size).
+
+    taken = read_time("images/image_1.jpg")      # naive datetime, with microseconds
+    times = scan_directory("images/")            # {path: datetime} for a whole run
+"""
+from __future__ import annotations
+
+import os
+import struct
+import threading
+from datetime import datetime
+from fnmatch import fnmatch
+from pathlib import Path
+
+_SOI = b"\xff\xd8"
+_APP1 = 0xE1
+_SOS = 0xDA
+_EOI = 0xD9
+_EXIF_HEADER = b"Exif\x00\x00"
+
+_EXIF_IFD = 0x8769                  # IFD0 pointer to the Exif IFD
+_DATETIME_ORIGINAL = 0x9003
+_SUBSEC_TIME_ORIGINAL = 0x9291
+_ASCII = 2
+
+_cache: dict[tuple, datetime] = {}
+_cache_lock = threading.Lock()
+
+
+def _app1(f) -> bytes | None:
+    # TIFF block of the Exif APP1 segment, None if the file has none
+    if f.read(2) != _SOI:
+        raise ValueError(f"{f.name} is not a JPEG file.")
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        kind = marker[1]
+        if kind == 0xFF:            # fill byte
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if kind in (_SOS, _EOI):    # image data starts, no metadata after this
+            return None
+        if 0xD0 <= kind <= 0xD7 or kind == 0x01:    # markers without a length
+            continue
+        (length,) = struct.unpack(">H", f.read(2))
+        if kind == _APP1:
+            segment = f.read(length - 2)
+            if segment.startswith(_EXIF_HEADER):
+                return segment[len(_EXIF_HEADER):]
+            continue                # XMP also lives in APP1
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def _ifd(tiff: bytes, offset: int, order: str) -> dict[int, tuple[int, int, bytes]]:
+    # tag -> (type, count, 4 byte value/offset field)
+    (n,) = struct.unpack_from(order + "H", tiff, offset)
+    entries = {}
+    for i in range(n):
+        tag, kind, count = struct.unpack_from(order + "HHI", tiff, offset + 2 + 12 * i)
+        entries[tag] = (kind, count, tiff[offset + 10 + 12 * i:offset + 14 + 12 * i])
+    return entries
+
+
+def _ascii(tiff: bytes, entry, order: str) -> str | None:
+    if entry is None or entry[0] != _ASCII:
+        return None
+    _, count, field = entry
+    if count <= 4:
+        raw = field[:count]
+    else:
+        (offset,) = struct.unpack(order + "I", field)
+        raw = tiff[offset:offset + count]
+    if len(raw) < count:
+        # cut off, "12:34:5" would still parse as a (wrong) time
+        raise struct.error("value outside the segment")
+    return raw.split(b"\x00", 1)[0].decode("ascii", "replace").strip()
+
+
+def parse_time(tiff: bytes) -> datetime | None:
+    """DateTimeOriginal + SubSecTimeOriginal of a TIFF/EXIF block"""
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None:
+        raise ValueError("Corrupt EXIF header.")
+    (ifd0,) = struct.unpack_from(order + "I", tiff, 4)
+    pointer = _ifd(tiff, ifd0, order).get(_EXIF_IFD)
+    if pointer is None:
+        return None
+    (exif_ifd,) = struct.unpack(order + "I", pointer[2])
+    tags = _ifd(tiff, exif_ifd, order)
+
+    text = _ascii(tiff, tags.get(_DATETIME_ORIGINAL), order)
+    if not text:
+        return None
+    taken = datetime.strptime(text, "%Y:%m:%d %H:%M:%S")
+    subsec = _ascii(tiff, tags.get(_SUBSEC_TIME_ORIGINAL), order)
+    if subsec and subsec.isdigit():
+        # digits of the fraction: "5" is half a second, "123" 123 ms
+        taken = taken.replace(microsecond=int(subsec[:6].ljust(6, "0")))
+    return taken
+
+
+def _read(path: Path) -> datetime:
+    try:
+        with open(path, "rb") as f:
+            tiff = _app1(f)
+        taken = parse_time(tiff) if tiff is not None else None
+    except struct.error:   # truncated file or offsets pointing outside the segment
+        raise ValueError(f"Corrupt EXIF header in {path}") from None
+    if taken is None:
+        raise ValueError(f"No datetime_original EXIF tag found in {path}")
+    return taken
+
+
+def read_time(image_path: str | Path, stat: os.stat_result | None = None) -> datetime:
+    """
+    Capture time of one photo as a naive datetime (as written by the camera),
+    with the sub-second part if the camera stored one.
+    """
+    path = Path(image_path)
+    stat = stat or path.stat()
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        taken = _cache.get(key)
+    if taken is None:
+        taken = _read(path)
+        with _cache_lock:
+            _cache[key] = taken
+    return taken
+
+
+def scan_directory(directory: str | Path, pattern: str = "*.jpg") -> dict[Path, datetime]:
+    """
+    read_time() for every file in `directory` matching `pattern`, from a
+    single os.scandir pass (its stat results feed the cache keys). Files
+    without a timestamp are left out.
+    """
+    times = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not fnmatch(entry.name, pattern) or not entry.is_file():
+                continue
+            try:
+                times[Path(entry.path)] = read_time(entry.path, entry.stat())
+            except ValueError:
+                continue
+    return times
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,171 @@
+# features.py
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Hashable, NamedTuple
+
+import numpy as np
+
+# keypoints and matches as numpy records instead of lists of cv2.KeyPoint / cv2.DMatch
+KEYPOINT_DTYPE = np.dtype([("x", np.float32), ("y", np.float32), ("size", np.float32),
+                           ("angle", np.float32), ("response", np.float32), ("octave", np.int32)])
+MATCH_DTYPE = np.dtype([("query", np.int32), ("train", np.int32), ("distance", np.float32)])
+
+
+class Frame(NamedTuple):
+    gray: Any           # decoded grayscale image (np.ndarray)
+    keypoints: Any      # KEYPOINT_DTYPE array
+    descriptors: Any    # (N, 32) uint8 ORB descriptors, None if nothing was found
+
+
+def keypoints_to_array(keypoints) -> np.ndarray:
+    return np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave) for kp in keypoints],
+                    dtype=KEYPOINT_DTYPE)
+
+
+def points(keypoints: np.ndarray) -> np.ndarray:
+    """(N, 2) float32 positions of a keypoint array"""
+    return np.column_stack((keypoints["x"], keypoints["y"]))
+
+
+def to_cv_keypoints(keypoints: np.ndarray) -> list:
+    # only for cv2.drawMatches and friends
+    import cv2
+
+    return [cv2.KeyPoint(float(k["x"]), float(k["y"]), float(k["size"]), float(k["angle"]),
+                         float(k["response"]), int(k["octave"])) for k in keypoints]
+
+
+def to_cv_matches(matches: np.ndarray) -> list:
+    import cv2
+
+    return [cv2.DMatch(int(m["query"]), int(m["train"]), float(m["distance"])) for m in matches]
+
+
+def knn_to_arrays(knn) -> tuple[np.ndarray, np.ndarray]:
+    """
+    cv2 kNN (k=2) result -> (best match per query, distance of the second
+    best). Queries without a match are left out, a missing second is inf.
+    """
+    rows = [m_n for m_n in knn if m_n]
+    matches = np.array([(m_n[0].queryIdx, m_n[0].trainIdx, m_n[0].distance) for m_n in rows], dtype=MATCH_DTYPE)
+    second = np.array([m_n[1].distance if len(m_n) > 1 else np.inf for m_n in rows], dtype=np.float32)
+    return matches, second
+
+
+def frame_key(image: str | Path, *params: Hashable) -> tuple:
+    """
+    Key for one decoded frame: resolved path + mtime, plus the detector
+    parameters, so a rewritten file or other settings never hit a stale entry.
+    """
+    path = Path(image)
+    return (str(path.resolve()), path.stat().st_mtime_ns, *params)
+
+
+class FeatureStore:
+    """
+    Small LRU cache of decoded and ORB-processed frames.
+
+    In the capture loop image 2 of one pair is image 1 of the next one,
+    so keeping the last couple of frames means every photo is decoded
+    and detected exactly once. Safe to share between worker threads.
+    """
+
+    def __init__(self, maxsize: int = 4):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self._frames: OrderedDict[tuple, Frame] = OrderedDict()
+        self._lock = threading.Lock()
+        # per-key locks for frames currently being loaded
+        self._loading: dict[tuple, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Frame | None:
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def put(self, key: tuple, frame: Frame) -> None:
+        with self._lock:
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.maxsize:
+                self._frames.popitem(last=False)
+
+    def get_or_load(self, key: tuple, load: Callable[[], Frame]) -> Frame:
+        """
+        Return the cached frame or build it with `load()`. Two threads asking
+        for the same frame at once (neighbouring pairs) load it only once.
+        """
+        frame = self.get(key)
+        if frame is not None:
+            return frame
+
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            # somebody else may have loaded it while we waited
+            with self._lock:
+                frame = self._frames.get(key)
+            if frame is None:
+                frame = load()
+                self.put(key, frame)
+        with self._lock:
+            self._loading.pop(key, None)
+        return frame
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+
+class DiskFeatureStore:
+    """
+    Keypoints and descriptors on disk, one compressed .npz per image and
+    detector settings. The key is a hash of the file contents, so a copied
+    or renamed archive still hits and a changed file never does.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(data: bytes, *params: Hashable) -> str:
+        digest = hashlib.blake2b(data, digest_size=16)
+        digest.update(repr(params).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.npz"
+
+    def load(self, key: str) -> tuple[np.ndarray, np.ndarray | None] | None:
+        try:
+            with np.load(self._path(key)) as data:
+                descriptors = data["descriptors"]
+                return data["keypoints"], (descriptors if descriptors.size else None)
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None     # missing or a half written file
+
+    def save(self, key: str, keypoints: np.ndarray, descriptors: np.ndarray | None) -> None:
+        if descriptors is None:
+            descriptors = np.empty((0, 32), np.uint8)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, keypoints=keypoints, descriptors=descriptors)
+        os.replace(tmp, self._path(key))
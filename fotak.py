@@ -1,27 +1,64 @@
 # fotak.py
 from __future__ import annotations
 
+import csv
+import os
+import queue
+import threading
 import time
 from pathlib import Path
-from typing import List
+from typing import List, NamedTuple
 try:
     from config import INTERVAL_S
 except:
     INTERVAL_S = 10
 
-try:
-    # This is what you said you're using
-    from picamzero import Camera
-except ImportError as e:
-    raise ImportError(
-        "Could not import camerazero. Make sure it's installed and you're running on the target device."
-    ) from e
+# picamzero is only imported by camera.PiCamera, when a photo is really taken
+from camera import Shot, encode_jpeg, get_camera
+from profiling import timed
 
 
-def _next_index(prefix: str, directory: Path) -> int:
+MANIFEST_NAME = "manifest.csv"
+
+
+class FrameRecord(NamedTuple):
+    """One line of the manifest"""
+    index: int
+    time: float     # unix seconds of the capture
+    path: str
+
+
+# next free index per (directory, prefix), seeded once from the manifest or a directory scan
+_sequences: dict[tuple[Path, str], int] = {}
+_sequence_lock = threading.Lock()
+
+
+def read_manifest(directory: str | Path, prefix: str | None = None) -> list[FrameRecord]:
+    """Frames recorded in directory/manifest.csv, in capture order. Empty if there is no manifest."""
+    try:
+        with open(Path(directory) / MANIFEST_NAME, newline="") as f:
+            rows = list(csv.reader(f))
+    except FileNotFoundError:
+        return []
+    records = []
+    for row in rows[1:]:
+        try:
+            record = FrameRecord(int(row[0]), float(row[1]), row[2])
+        except (ValueError, IndexError):
+            continue    # torn last line
+        if prefix is None or Path(record.path).name.startswith(f"{prefix}_"):
+            records.append(record)
+    return sorted(records, key=lambda r: (r.time, r.index))
+
+
+def _scan_index(prefix: str, directory: Path) -> int:
     """
     Finds the next available numeric index for files like prefix_012.jpg.
     """
+    records = read_manifest(directory, prefix)
+    if records:
+        return max(r.index for r in records) + 1
+
     existing = sorted(directory.glob(f"{prefix}_*.jpg"))
     max_idx = 0
     for p in existing:
@@ -34,7 +71,34 @@ def _next_index(prefix: str, directory: Path) -> int:
         except Exception:
             # Ignore weirdly named files
             pass
-    return max_idx + 1
+    # photos named by their timestamp have no index, start after them
+    return max(max_idx, len(existing)) + 1
+
+
+def _next_index(prefix: str, directory: Path) -> int:
+    """
+    Next index for prefix in directory. Only the first call per directory
+    looks at the disk, after that it is a counter.
+    """
+    key = (directory.resolve(), prefix)
+    with _sequence_lock:
+        if key not in _sequences:
+            _sequences[key] = _scan_index(prefix, directory)
+        index = _sequences[key]
+        _sequences[key] = index + 1
+    return index
+
+
+def _record(directory: Path, index: int, taken: float, path: Path) -> None:
+    # one short append per photo, so batch.list_frames doesn't have to glob
+    manifest = directory / MANIFEST_NAME
+    with _sequence_lock:
+        new = not manifest.exists()
+        with open(manifest, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(["index", "time", "path"])
+            writer.writerow([index, f"{taken:.03f}", path.name])
 
 def take_three_photos(
     prefix: str = "atlas_photo",
@@ -50,9 +114,7 @@ def take_three_photos(
     directory = Path(directory)
     directory.mkdir(parents=True, exist_ok=True)
 
-    start_idx = _next_index(prefix, directory)
-
-    camera = Camera()
+    camera = get_camera()
 
     # Optional: set camera options if your camerazero supports them.
     # These names vary by implementation; comment out if they error.
@@ -71,41 +133,121 @@ def take_three_photos(
         if now < target_time:
             time.sleep(target_time - now)
 
-        filename = f"{prefix}_{start_idx + i:03d}.jpg"
+        index = _next_index(prefix, directory)
+        filename = f"{prefix}_{index:03d}.jpg"
         path = directory / filename
 
         # camerazero usually provides .take_photo("file.jpg") or similar
+        taken = time.time()
         camera.take_photo(str(path))
+        _record(directory, index, taken, path)
 
         paths.append(path)
 
     return paths
 
+@timed("capture")
 def take_photo(
     prefix: str = "atlas_photo",
     directory: str | Path = ".",
     camera = None
 ) -> Path:
     """
-    take one photo from picamerazero and return its path as str
+    take one photo and return its path, by default from picamerazero
+    (see camera.get_camera for the other backends)
     """
 
     if camera is None:
-        camera = Camera()
+        camera = get_camera()
 
     directory = Path(directory)
     directory.mkdir(parents=True, exist_ok=True)
 
-    start_idx = _next_index(prefix, directory)
+    index = _next_index(prefix, directory)
 
-    filename = f"{prefix}_{start_idx + time.time():.03f}.jpg"
+    taken = time.time()
+    filename = f"{prefix}_{taken:.03f}.jpg"
     path = directory / filename
 
     # camerazero usually provides .take_photo("file.jpg") or similar
     camera.take_photo(str(path))
+    _record(directory, index, taken, path)
 
     return path
 
+class PhotoWriter:
+    """
+    Encodes and saves captured frames on a background thread, so the archive
+    copy never holds up the analysis of the frame in memory. If the card
+    falls `maxsize` photos behind, new photos are dropped (and counted)
+    instead of stalling the capture thread.
+    """
+
+    def __init__(self, maxsize: int = 8):
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="photo-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, shot: Shot, path: str | Path) -> bool:
+        """Queue a photo for saving, False if the queue is full and it was dropped"""
+        try:
+            self._queue.put_nowait((shot, Path(path)))
+        except queue.Full:
+            self.dropped += 1
+            print(f"photo writer is behind, not saving {path} ({self.dropped} dropped)")
+            return False
+        return True
+
+    def _run(self) -> None:
+        while (item := self._queue.get()) is not None:
+            shot, path = item
+            # written under a temporary name, so nobody globbing *.jpg sees half a photo
+            tmp = path.with_name(path.name + ".part")
+            try:
+                tmp.write_bytes(encode_jpeg(shot.image, shot.time))
+                os.replace(tmp, path)
+                self.written += 1
+            except Exception as e:
+                print(f"could not save {path}: {e}")
+                self.failed += 1
+
+    def close(self, timeout: float | None = None) -> None:
+        """Write what is still queued and stop the thread"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+
+@timed("capture")
+def take_frame(
+    prefix: str = "atlas_photo",
+    directory: str | Path = ".",
+    camera = None,
+    writer: PhotoWriter | None = None,
+) -> tuple[Path, Shot]:
+    """
+    take one frame into memory, returns the path it is saved under and the
+    frame itself. With a writer the JPEG is saved in the background,
+    without one before returning.
+    """
+    if camera is None:
+        camera = get_camera()
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    index = _next_index(prefix, directory)
+    shot = camera.grab()
+    path = directory / f"{prefix}_{shot.time:.03f}.jpg"
+    _record(directory, index, shot.time, path)
+    if writer is None:
+        path.write_bytes(encode_jpeg(shot.image, shot.time))
+    else:
+        writer.submit(shot, path)
+    return path, shot
+
 if __name__ == "__main__":
     photos = take_three_photos(prefix="atlas_photo", directory=".", interval_s=35.0)
     print("Captured:")
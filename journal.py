@@ -0,0 +1,142 @@
+# journal.py
+"""
+Append-only journal of the per-pair measurements.
+
+One JSON object per line, written through a buffered file and fsynced
+every `sync_every` records or `sync_interval` seconds, so a crash loses
+at most the last few pairs. On restart replay() gives the records back,
+a half written last line is ignored.
+
+Every run writes a start record ({"event": "start"}) and, when it
+finishes normally, an end record; all records carry the run id. After a
+crash unfinished_run() finds the run that never ended, so a fresh start
+does not pick up the speeds of an earlier (test) run. result.txt is derived from the
+journal with write_result(), which replaces the file atomically.
+"""
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+JOURNAL_PATH = "journal.jsonl"
+RESULT_PATH = "result.txt"
+
+
+class Journal:
+    def __init__(self, path: str | Path = JOURNAL_PATH, sync_every: int = 10, sync_interval: float = 30.0,
+                 run: str | None = None):
+        self.path = Path(path)
+        self.run = run or uuid.uuid4().hex[:12]     # pass the id of an unfinished run to continue it
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._file = open(self.path, "a", buffering=64 * 1024, encoding="utf-8")
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def record(self, **fields) -> dict:
+        """Append one record, `t` (unix time) and `run` are added if missing"""
+        fields.setdefault("t", round(time.time(), 3))
+        fields.setdefault("run", self.run)
+        line = json.dumps(fields, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+        return fields
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def start(self) -> dict:
+        record = self.record(event="start")
+        self.sync()
+        return record
+
+    def end(self) -> dict:
+        """Mark the run finished, it is not resumed after this"""
+        record = self.record(event="end")
+        self.sync()
+        return record
+
+    def sync(self) -> None:
+        with self._lock:
+            self._sync()
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def replay(path: str | Path = JOURNAL_PATH, since: float | None = None) -> list[dict]:
+    """Records of the journal in write order, only the ones at or after `since` if given"""
+    records = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue    # torn write from a crash
+                if since is None or record.get("t", 0) >= since:
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def unfinished_run(path: str | Path = JOURNAL_PATH,
+                   since: float | None = None) -> tuple[str | None, float | None, list[dict]]:
+    """
+    (run id, start time, records) of the last run in the journal if it
+    started at or after `since` and never wrote its end record, else
+    (None, None, []). The records are the ones of that run without the
+    start record, the start time is the `t` of the start record.
+    """
+    run, start, records = None, None, []
+    for record in replay(path):
+        event = record.get("event")
+        if event == "start":
+            run, start, records = record.get("run"), record.get("t", 0), []
+        elif event == "end" and record.get("run") == run:
+            run, start, records = None, None, []
+        elif run is not None and record.get("run") == run:
+            records.append(record)
+    if run is None or (since is not None and start < since):
+        return None, None, []
+    return run, start, records
+
+
+def write_result(speed: float, path: str | Path = RESULT_PATH) -> None:
+    """Write result.txt so a reader sees either the old or the new value, never half of it"""
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{speed:.03f} km/s")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
@@ -1,65 +1,259 @@
-from picamzero import Camera
 from pathlib import Path
 import time, math
+import os, queue, threading
 import EXIF  # EXIF.py -> module name EXIF
 from config import INTERVAL_S
-from exif import Image
-from fotak import take_photo
-from orbit import get_speed_approx
+from camera import get_camera
+from fotak import PhotoWriter, read_manifest, take_frame
+from orbit import get_speed_approx, prepare_ephemeris
 import traceback
 from datetime import datetime
 import calc
+import profiling
+import numpy as np
+from journal import Journal, unfinished_run, write_result
+from scheduler import CaptureScheduler, MIN_USABLE
+from tracker import MultiFrameSolver
 
 TOLERANCE = 1 # in km/s
 RUNTIME = 10*60     # 10 Minutes, in second
 INTERVAL = INTERVAL_S     # in seconds
+MAX_PHOTOS = 42
+WORKERS = max(1, (os.cpu_count() or 1) - 1)     # one core stays with the camera thread
+QUEUE_SIZE = 2*WORKERS      # pairs waiting for a worker, when full new pairs are skipped
+WINDOW = 3      # frames per tracker.MultiFrameSolver window, below 2 every pair counts on its own
 
 
-def photo_and_process(cam, last_photo=None) -> tuple[str, float | None, list[float]]:
-    photo = take_photo('image', 'images/', cam)
-    if last_photo is not None:
-        try:
-            speed, speeds = EXIF.run(last_photo, photo)
-        except Exception as e:
-            print(f"EXIF failed for {last_photo} -> {photo}: {e}")
-            traceback.print_exc()
-            speed = None
-            speeds = []
-    else:
-        speed = None
-        speeds = []
-    return (str(photo), speed, speeds)
+def process_pair(last_photo: str, photo: str, shots: tuple | None = None) \
+        -> tuple[float | None, list[float], dict, dict, EXIF.MatchedPair | None]:
+    """
+    (speed, all speeds, timings, match quality, inlier matches) of one pair, speed is None if it failed.
+    timings has the total ("exif") and the seconds of every profiling span the pair went through.
+    The inlier matches are only there for the ORB tier, for the multi-frame solver.
+    With `shots` (camera.Shot of both photos) the frames in memory are used, not the files.
+    """
+    start = time.perf_counter()
+    quality = {}
+    matched = None
+    try:
+        with profiling.collect() as stages:
+            if shots is None:
+                speed, measured_all = EXIF.run(last_photo, photo)
+            else:
+                speed, measured_all = EXIF.run_shots(*shots, last_photo, photo)
+        # thread local, set by this pair
+        quality = {"tier": EXIF.last.tier, "velocity": EXIF.last.velocity.tolist()}
+        if EXIF.last.quality is not None:
+            quality.update(matches=EXIF.last.quality.matches, inliers=EXIF.last.quality.inliers)
+        matched = EXIF.last.matched
+    except Exception as e:
+        print(f"EXIF failed for {last_photo} -> {photo}: {e}")
+        traceback.print_exc()
+        speed, measured_all = None, []
+    timings = {"exif": round(time.perf_counter() - start, 4)}
+    timings.update((name, round(seconds, 4)) for name, seconds in stages.items())
+    return speed, measured_all, timings, quality, matched
 
-def main() -> int:
-    num_of_photos = 0
+
+def window_estimate(solver: MultiFrameSolver, last_photo: str, photo: str, matched: EXIF.MatchedPair | None):
+    """
+    The solver's estimate over the window ending with this pair, None if
+    there is none: a pair without ORB matches (phase tier, failed, skipped)
+    breaks the tracks and starts a new window.
+    """
+    if matched is None:
+        solver.reset()
+        return None
+    try:
+        return solver.add_matched(last_photo, photo, matched)
+    except ValueError as e:
+        print(f"no window estimate for {photo}: {e}")
+        return None
+
+
+def capture(camera, pairs: queue.Queue, results: queue.Queue, scheduler: CaptureScheduler,
+            writer: PhotoWriter) -> None:
+    """
+    Producer: take photos when the scheduler says so and queue every
+    consecutive pair. Never waits for the workers, so the cadence can't drift.
+    The frames go to the workers in memory, `writer` saves the JPEGs on the side.
+    """
     last_photo: str | None = None
-    speeds: list[float] = []
+    last_shot = None
+    index = 0
+    try:
+        while (shot_at := scheduler.next_shot()) is not None:
+            scheduler.wait_until(shot_at)
+            interval = scheduler.interval
+
+            # one bad grab costs this photo and the pairs around it, not the rest of the run
+            try:
+                path, shot = take_frame('image', 'images/', camera, writer)
+            except Exception as e:
+                print(f"capture failed: {e}")
+                traceback.print_exc()
+                # the slot is used up, the next try comes an interval later
+                scheduler.shot_taken(shot_at)
+                last_photo = None
+                continue
+            photo = str(path)
+            scheduler.shot_taken(shot_at)
+            # late for this shot by more than one interval: the schedule can't be kept
+            profiling.check_budget("capture", time.monotonic() - shot_at, interval)
+
+            # night, porthole frame or thick cloud: not worth a worker, and breaks the chain
+            try:
+                usable = EXIF.usable_fraction(shot.gray)
+            except Exception as e:
+                print(f"could not check {photo}: {e}")
+                traceback.print_exc()
+                last_photo = None
+                continue
+            if usable < MIN_USABLE:
+                print(f"skipping {photo}, only {usable:.0%} usable")
+                last_photo = None
+                continue
+
+            if last_photo is not None:
+                try:
+                    pairs.put_nowait((index, last_photo, photo, (last_shot, shot)))
+                except queue.Full:
+                    print(f"workers are behind, skipping {last_photo} -> {photo}")
+                    results.put((index, last_photo, photo, None, [], {}, {}, None))
+                index += 1
+            last_photo, last_shot = photo, shot
+    finally:
+        # the workers stop, and with them the aggregation, whatever happened here
+        for _ in range(WORKERS):
+            pairs.put(None)
+
+
+def worker(pairs: queue.Queue, results: queue.Queue) -> None:
+    """Consumer: run EXIF on queued pairs until the capture thread is done"""
+    while True:
+        item = pairs.get()
+        if item is None:
+            results.put(None)
+            return
+        index, last_photo, photo, shots = item
+        results.put((index, last_photo, photo, *process_pair(last_photo, photo, shots)))
+
+
+def photos_taken(records: list[dict], since: float, directory: str = "images/") -> set[str]:
+    """
+    Names of the photos a run has taken since `since`: the ones in its
+    journal records plus the manifest, which also has the skipped ones.
+    """
+    names = {Path(record[key]).name for record in records for key in ("image_1", "image_2") if record.get(key)}
+    names.update(Path(frame.path).name for frame in read_manifest(directory) if frame.time >= since)
+    return names
+
+
+def main() -> int:
+    stats = calc.RunningStats()
     start_time = time.time()
-    camera = Camera()
-
-    while start_time + RUNTIME > time.time() and num_of_photos < 42:
-        timer_start = time.time()
-        last_photo, speed, measured_all = photo_and_process(camera, last_photo)
-        num_of_photos += 1
-        print(last_photo, speed)
-        if speed is not None: # and abs(speed - get_speed_approx()) < TOLERANCE:
-            # speeds += measured_all
-            speeds.append(speed)
-
-            if len(speeds) > 1:
-                avg_speed, std = calc.do_statistik(speeds)
-            else:
-                avg_speed = speed
-                std = 0.0
-            with open("result.txt", "w") as f:
-                f.write(f"{avg_speed:.03f} km/s")
-                print(f"{avg_speed} ± {std:.02f} km/s")
-        
-        while time.time() < timer_start + INTERVAL:
-            time.sleep(0.3)
-
-        
-            
-            
+    # after a crash and restart, carry on from the pairs measured so far in this run,
+    # within what is left of its time and photos
+    run, started, records = unfinished_run(since=start_time - RUNTIME)
+    runtime, max_photos = RUNTIME, MAX_PHOTOS
+    if run is not None:
+        runtime = max(0.0, started + RUNTIME - start_time)
+        max_photos = max(0, MAX_PHOTOS - len(photos_taken(records, started)))
+        print(f"resuming run {run}, {runtime:.0f} s and {max_photos} photos left")
+    for record in records:
+        speed = record.get("window_speed", record.get("speed"))
+        if speed is not None:
+            stats.add(speed)
+    written = None
+    if len(stats):
+        print(f"resuming with {len(stats)} speeds from the journal")
+        written = f"{stats.estimate()[0]:.03f}"
+        write_result(stats.estimate()[0])
+    journal = Journal(run=run)
+    if run is None:
+        journal.start()
+    deadline = time.monotonic() + runtime
+    # orbit lookups during the run interpolate this instead of propagating
+    prepare_ephemeris(start_time, runtime + 60)
+    # frames of every pair in flight plus the ones about to be reused
+    EXIF.FEATURE_STORE.maxsize = 2*WORKERS + 2
+    # "pi" on the Astro Pi, "mock" or "replay:<dir>" to try the whole loop anywhere else
+    camera = get_camera(os.environ.get("ASTROPI_CAMERA", "pi"))
+    scheduler = CaptureScheduler(deadline, max_photos, WORKERS, INTERVAL)
+    writer = PhotoWriter()
+    # feature tracks over the last WINDOW frames instead of every pair on its own
+    solver = MultiFrameSolver(WINDOW) if WINDOW >= 2 else None
+
+    pairs: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+    results: queue.Queue = queue.Queue()
+    threads = [threading.Thread(target=capture, args=(camera, pairs, results, scheduler, writer), daemon=True)]
+    threads += [threading.Thread(target=worker, args=(pairs, results), daemon=True) for _ in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+
+    # aggregate in capture order, whatever order the workers finish in
+    pending: dict[int, tuple] = {}
+    next_index = 0
+    running = WORKERS
+    try:
+        while running:
+            try:
+                item = results.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                print("out of time, dropping pairs still in progress")
+                break
+            if item is None:
+                running -= 1
+                continue
+            pending[item[0]] = item
+
+            while next_index in pending:
+                _, last_photo, photo, speed, measured_all, timings, quality, matched = pending.pop(next_index)
+                next_index += 1
+                print(photo, speed)
+                window = None
+                if solver is not None:
+                    with profiling.span("tracker"):
+                        window = window_estimate(solver, last_photo, photo, matched if speed is not None else None)
+                if window is not None:
+                    quality.update(window_speed=window.speed, window_std=window.std, window_frames=window.n_frames,
+                                   window_tracks=window.n_tracks)
+                    print(f"{photo} {window.speed} over {window.n_frames} frames")
+                # each worker gets a new pair every WORKERS intervals
+                profiling.check_budget("exif", timings.get("exif", 0.0), WORKERS*scheduler.interval)
+                journal.record(image_1=last_photo, image_2=photo, speed=speed,
+                               std=float(np.std(measured_all)) if measured_all else None,
+                               n_speeds=len(measured_all), timings=timings, **quality)
+                if speed is None and timings:
+                    # a failed pair counts as a bad one, the next photo comes sooner
+                    scheduler.observe(timings["exif"], matches=0, inliers=0)
+                elif speed is not None:
+                    scheduler.observe(timings["exif"], quality.get("velocity"),
+                                      quality.get("matches"), quality.get("inliers"))
+                if speed is not None: # and abs(speed - get_speed_approx()) < TOLERANCE:
+                    with profiling.span("stats"):
+                        # the window fit where there is one, the pair itself (e.g. phase tier) otherwise
+                        stats.add(window.speed if window is not None else speed)
+                        avg_speed, std = stats.estimate()
+                    if f"{avg_speed:.03f}" != written:     # result.txt only changes in the 3rd decimal
+                        written = f"{avg_speed:.03f}"
+                        write_result(avg_speed)
+                    print(f"{avg_speed} ± {std:.02f} km/s")
+        # only a run that got here is finished, after a crash the next start resumes it
+        journal.end()
+    finally:
+        journal.close()
+        # the last few photos may still be on their way to the SD card
+        writer.close(timeout=10)
+        if writer.dropped or writer.failed:
+            print(f"photos saved: {writer.written}, dropped: {writer.dropped}, failed: {writer.failed}")
+        if profiling.enabled():
+            print(profiling.report())
+            # ASTROPI_TRACE=trace.json: open in chrome://tracing or ui.perfetto.dev
+            if os.environ.get("ASTROPI_TRACE"):
+                profiling.dump_chrome_trace(os.environ["ASTROPI_TRACE"])
+    return 0
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
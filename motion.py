@@ -0,0 +1,168 @@
+# motion.py
+"""
+Motion estimation between two frames: a similarity transform (rotation,
+uniform scale, translation), the model cv2.estimateAffinePartial2D fits.
+
+estimate_motion() tries the cheapest way first:
+
+1. prior: the previous pair's transform, its translation scaled to this
+   pair's time difference. Consecutive ISS frames move almost the same, so
+   usually it only needs a refit on its inliers. No sampling at all.
+2. PROSAC: minimal samples (2 matches) drawn from the best matches first,
+   growing the pool as it goes, stopping as soon as the standard RANSAC
+   bound for the current inlier ratio is met.
+3. cv2.estimateAffinePartial2D with the full iteration budget, if both fail.
+"""
+from __future__ import annotations
+
+import math
+import threading
+from typing import NamedTuple
+
+import numpy as np
+
+from lazy import LazyModule
+
+cv2 = LazyModule("cv2")
+
+THRESHOLD = 3.0             # px reprojection error of an inlier, as in EXIF.run
+CONFIDENCE = 0.999
+MIN_INLIERS = 20
+MIN_PRIOR_RATIO = 0.5       # the prior is used if it explains at least this share of the matches
+MIN_PROSAC_RATIO = 0.2      # below this inlier ratio PROSAC gives up and cv2 RANSAC runs
+BATCH = 32                  # hypotheses scored per numpy step
+REFITS = 3
+
+
+class MotionEstimate(NamedTuple):
+    M: np.ndarray           # 2x3, pts2 ~ M @ [pts1, 1]
+    inliers: np.ndarray     # bool mask over the matches
+    iterations: int         # hypotheses scored (0 if the prior was good enough)
+    method: str             # "prior", "prosac" or "ransac"
+
+
+def _complex(pts) -> np.ndarray:
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    return pts[:, 0] + 1j * pts[:, 1]
+
+
+def _to_matrix(a: complex, b: complex) -> np.ndarray:
+    # w = a*z + b  <=>  [x', y'] = [[ar, -ai], [ai, ar]] @ [x, y] + [br, bi]
+    return np.array([[a.real, -a.imag, b.real], [a.imag, a.real, b.imag]])
+
+
+def _from_matrix(M) -> tuple[complex, complex]:
+    return complex(M[0, 0], M[1, 0]), complex(M[0, 2], M[1, 2])
+
+
+def fit_similarity(z: np.ndarray, w: np.ndarray) -> tuple[complex, complex]:
+    """Least squares a, b of w = a*z + b (complex points)"""
+    zm, wm = z.mean(), w.mean()
+    dz = z - zm
+    a = np.vdot(dz, w - wm) / max(np.vdot(dz, dz).real, 1e-12)
+    return complex(a), complex(wm - a * zm)
+
+
+def _refit(z, w, a, b, threshold: float):
+    # rescore and refit on the inliers until the inlier set stops growing
+    inliers = np.abs(a * z + b - w) <= threshold
+    for _ in range(REFITS):
+        if inliers.sum() < 2:
+            break
+        a_new, b_new = fit_similarity(z[inliers], w[inliers])
+        new = np.abs(a_new * z + b_new - w) <= threshold
+        if new.sum() < inliers.sum():
+            break
+        a, b, done = a_new, b_new, np.array_equal(new, inliers)
+        inliers = new
+        if done:
+            break
+    return a, b, inliers
+
+
+def _prosac(z, w, order, threshold: float, max_iters: int, confidence: float, rng):
+    n = len(z)
+    z, w = z[order], w[order]
+    best_count, best = 0, None
+    needed = max_iters
+    pool = min(n, max(8, n // 10))     # start from the best 10% of the matches
+    iterations = 0
+    while iterations < min(needed, max_iters):
+        i = rng.integers(0, pool, BATCH)
+        j = rng.integers(0, pool, BATCH)
+        ok = (i != j) & (np.abs(z[i] - z[j]) > 1e-6)
+        i, j = i[ok], j[ok]
+        a = (w[i] - w[j]) / (z[i] - z[j])
+        b = w[i] - a * z[i]
+        # (batch, n) residuals, cheap for a few thousand matches
+        counts = (np.abs(a[:, None] * z[None, :] + b[:, None] - w[None, :]) <= threshold).sum(axis=1)
+        iterations += BATCH
+        if len(counts) and counts.max() > best_count:
+            k = int(counts.argmax())
+            best_count, best = int(counts[k]), (complex(a[k]), complex(b[k]))
+            ratio = best_count / n
+            needed = math.log(1 - confidence) / math.log(max(1 - ratio * ratio, 1e-12)) if ratio < 1 else 0
+        pool = min(n, pool * 2)
+    return best, best_count, iterations
+
+
+def estimate_motion(pts1, pts2, distances=None, prior: np.ndarray | None = None,
+                    threshold: float = THRESHOLD, max_iters: int = 2000,
+                    confidence: float = CONFIDENCE, seed: int = 0) -> MotionEstimate:
+    """
+    Similarity transform pts1 -> pts2 with its inlier mask. `distances`
+    (descriptor distance per match) orders the matches for PROSAC, `prior`
+    is a 2x3 transform expected to be close, see MotionModel.predict().
+    """
+    z, w = _complex(pts1), _complex(pts2)
+    n = len(z)
+    if n < 2:
+        raise ValueError("Need at least 2 matches for a motion estimate.")
+
+    if prior is not None:
+        a, b, inliers = _refit(z, w, *_from_matrix(prior), threshold)
+        if inliers.sum() >= max(MIN_INLIERS, MIN_PRIOR_RATIO * n):
+            return MotionEstimate(_to_matrix(a, b), inliers, 0, "prior")
+
+    order = np.argsort(distances, kind="stable") if distances is not None else np.arange(n)
+    best, count, iterations = _prosac(z, w, order, threshold, max_iters, confidence, np.random.default_rng(seed))
+    if best is not None and count >= max(MIN_INLIERS, MIN_PROSAC_RATIO * n):
+        a, b, inliers = _refit(z, w, *best, threshold)
+        return MotionEstimate(_to_matrix(a, b), inliers, iterations, "prosac")
+
+    M, inliers = cv2.estimateAffinePartial2D(
+        np.asarray(pts1, np.float32).reshape(-1, 1, 2), np.asarray(pts2, np.float32).reshape(-1, 1, 2),
+        method=cv2.RANSAC, ransacReprojThreshold=threshold, maxIters=max_iters, confidence=confidence,
+    )
+    if M is None or inliers is None:
+        raise ValueError("RANSAC failed (no inliers).")
+    return MotionEstimate(M, inliers.ravel().astype(bool), iterations + max_iters, "ransac")
+
+
+class MotionModel:
+    """
+    The last accepted transform, as a rate so it can seed pairs with a
+    different time difference. Shared between worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._M: np.ndarray | None = None
+        self._time_difference = 0.0
+
+    def predict(self, time_difference: float) -> np.ndarray | None:
+        with self._lock:
+            if self._M is None:
+                return None
+            M = self._M.copy()
+            M[:, 2] *= time_difference / self._time_difference
+            return M
+
+    def update(self, M: np.ndarray, time_difference: float) -> None:
+        with self._lock:
+            self._M = np.array(M, dtype=np.float64)
+            self._time_difference = time_difference
+
+    def reset(self) -> None:
+        with self._lock:
+            self._M = None
@@ -1,50 +1,173 @@
-from skyfield.api import load, wgs84
-from skyfield.framelib import ICRS
-from skyfield.positionlib import Geocentric
-from astro_pi_orbit import ISS
+from __future__ import annotations
 import numpy as np
 from datetime import timezone, datetime
+import threading
+from lazy import LazyModule
+
+# Skyfield and astro_pi_orbit are slow to import (astro_pi_orbit even loads its
+# ephemeris files), so they are only imported when an orbit is really needed
+skyfield_api = LazyModule("skyfield.api")
+skyfield_framelib = LazyModule("skyfield.framelib")
+astro_pi_orbit = LazyModule("astro_pi_orbit")
 
 EARTH_RADIUS = 6378000 # m
 
-ts = load.timescale()
+_ts = None
+
+# ISS() parses the TLE file every time, so everything below shares one propagator
+_iss = None
+_iss_lock = threading.Lock()
+# reference observer for get_azimut
+_observer = None
+# optional precomputed table, see prepare_ephemeris()
+_ephemeris: Ephemeris | None = None
+
+
+def get_timescale():
+    global _ts
+    if _ts is None:
+        _ts = skyfield_api.load.timescale()
+    return _ts
+
+
+def __getattr__(name: str):
+    # orbit.ts used to be created at import time
+    if name == "ts":
+        return get_timescale()
+    raise AttributeError(f"module 'orbit' has no attribute {name!r}")
+
+
+def get_iss():
+    global _iss
+    with _iss_lock:
+        if _iss is None:
+            _iss = astro_pi_orbit.ISS()
+    return _iss
+
+
+def _get_observer():
+    global _observer
+    if _observer is None:
+        _observer = skyfield_api.wgs84.latlon(0, 90)
+    return _observer
 
 def get_time(time_s: float | None | datetime):
     if time_s is None:
-        return ts.now()
+        return get_timescale().now()
     
     if isinstance(time_s, float):
-        time_s = datetime.fromtimestamp(time_s)
+        # unix seconds, the same instant whatever the local time zone of this machine
+        time_s = datetime.fromtimestamp(time_s, timezone.utc)
     
     if time_s.tzinfo is None:
         time_s = time_s.replace(tzinfo=timezone.utc)   # EXIF timestamps usually have no tz; treat as UTC
     else:
         time_s = time_s.astimezone(timezone.utc)
 
-    return ts.from_datetime(time_s)   # Skyfield Time object
+    return get_timescale().from_datetime(time_s)   # Skyfield Time object
+
+class Ephemeris:
+    """
+    ISS state sampled every `step` seconds from `start` for `duration` seconds.
+    Queries inside the window are answered by linear interpolation (about a
+    metre of error at 1 s steps) instead of a Skyfield propagation.
+    """
+
+    def __init__(self, start: float | None | datetime = None, duration: float = 600, step: float = 1.0):
+        t0 = get_time(start)
+        offsets = np.arange(int(np.ceil(duration / step)) + 1) * step
+        times = get_timescale().tt_jd(t0.tt + offsets / 86400.0)
+
+        iss = get_iss()
+        pos = iss.at(times)
+        subpoint = pos.subpoint()
+        _, az, _ = (iss - _get_observer()).at(times).altaz()
+
+        self.jd = times.tt
+        self.xyz = pos.position.m                   # (3, n) ICRS
+        self.xyz_ecef = pos.frame_xyz(skyfield_framelib.ICRS).m   # (3, n)
+        self.speed = pos.speed().km_per_s
+        self.height = pos.distance().m - EARTH_RADIUS
+        self.lat = subpoint.latitude.radians
+        # unwrap so interpolation never runs across the +-pi / 0-2pi jump
+        self.lon = np.unwrap(subpoint.longitude.radians)
+        self.azimuth = np.unwrap(az.radians)
+
+    def covers(self, t) -> bool:
+        return bool(self.jd[0] <= t.tt <= self.jd[-1])
+
+    def _interp(self, t, values):
+        return np.interp(t.tt, self.jd, values)
+
+    def position(self, t, ecef: bool = False):
+        xyz = self.xyz_ecef if ecef else self.xyz
+        return np.array([self._interp(t, xyz[i]) for i in range(3)])
+
+    def get_speed(self, t) -> float:
+        return float(self._interp(t, self.speed))
+
+    def get_height(self, t) -> float:
+        return float(self._interp(t, self.height))
+
+    def get_azimut(self, t) -> float:
+        return float(self._interp(t, self.azimuth) % (2 * np.pi))
+
+    def get_pos(self, t):
+        lon = (self._interp(t, self.lon) + np.pi) % (2 * np.pi) - np.pi
+        return float(self._interp(t, self.lat)), float(lon)
+
+
+def prepare_ephemeris(start: float | None | datetime = None, duration: float = 600, step: float = 1.0) -> Ephemeris:
+    """
+    Precompute the ISS state for the run window, so orbit lookups during the
+    run don't propagate anything. Times outside the window still work, they
+    just fall back to Skyfield.
+    """
+    global _ephemeris
+    _ephemeris = Ephemeris(start, duration, step)
+    return _ephemeris
+
+
+def clear_ephemeris() -> None:
+    global _ephemeris
+    _ephemeris = None
+
+
+def _table(t) -> Ephemeris | None:
+    if _ephemeris is not None and _ephemeris.covers(t):
+        return _ephemeris
+    return None
+
 
 def position_matrix_ecef(time_s: float | None | datetime = None):
-    iss = ISS()
-    geocentric = iss.at(get_time(time_s))
-    x, y, z = geocentric.frame_xyz(ICRS).m  # meters in rotating frame
+    t = get_time(time_s)
+    table = _table(t)
+    if table is not None:
+        return table.position(t, ecef=True)
+
+    geocentric = get_iss().at(t)
+    x, y, z = geocentric.frame_xyz(skyfield_framelib.ICRS).m  # meters in rotating frame
     return np.array([x, y, z])
 
 
 def position_matrix(time_s: float | None | datetime = None):
-    iss = ISS()
-    geocentric = iss.at(get_time(time_s))
+    t = get_time(time_s)
+    table = _table(t)
+    if table is not None:
+        return table.position(t)
+
+    geocentric = get_iss().at(t)
     x, y, z = geocentric.position.m  # meters in ICRS / inertial frame
     return np.array([x, y, z])
 
 def get_speed_approx(time_s: float | None | datetime = None) -> float:
-    iss = ISS()
-
-    
-    pos = iss.at(get_time(time_s))
-
-
-    # Speed (km/s)
-    speed = pos.speed().km_per_s
+    t = get_time(time_s)
+    table = _table(t)
+    if table is not None:
+        speed = table.get_speed(t)
+    else:
+        # Speed (km/s)
+        speed = get_iss().at(t).speed().km_per_s
 
     print(f"ISS speed: {speed:.3f} km/s")
     return speed
@@ -52,26 +175,34 @@ def get_speed_approx(time_s: float | None | datetime = None) -> float:
 
 def get_height() -> float:
     input("pozor")
-    iss = ISS()
-    return iss.coordinates().elevation.m
+    return get_iss().coordinates().elevation.m
 
 def get_height_at(time_s: float | None | datetime):
-    iss = ISS()
+    t = get_time(time_s)
+    table = _table(t)
+    if table is not None:
+        return table.get_height(t)
 
-    pos = iss.at(get_time(time_s))
+    pos = get_iss().at(t)
     height = pos.distance().m-EARTH_RADIUS
     return height
 
 def get_azimut(time_s: float | None | datetime = None):
-    iss = ISS()
-    guy = wgs84.latlon(0, 90)
-    diff = iss - guy
+    t = get_time(time_s)
+    table = _table(t)
+    if table is not None:
+        return table.get_azimut(t)
 
-    _, az, _ = diff.at(get_time(time_s)).altaz()
+    diff = get_iss() - _get_observer()
+    _, az, _ = diff.at(t).altaz()
     return az.radians
 
 def get_pos(time_s: float | None | datetime = None):
-    iss = ISS()
-    coordinates = iss.at(get_time(time_s)).subpoint()
+    t = get_time(time_s)
+    table = _table(t)
+    if table is not None:
+        return table.get_pos(t)
+
+    coordinates = get_iss().at(t).subpoint()
     # print(coordinates)
-    return coordinates.latitude.radians, coordinates.longitude.radians
\ No newline at end of file
+    return coordinates.latitude.radians, coordinates.longitude.radians
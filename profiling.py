@@ -0,0 +1,194 @@
+# profiling.py
+"""
+Per-stage timing spans.
+
+    with span("orb"):
+        ...
+
+    @timed("capture")
+    def take_photo(...): ...
+
+Off by default; enable() or ASTROPI_PROFILE=1 turns it on. While off,
+span() hands back one shared no-op context manager and timed() is a
+single flag check, so the instrumentation can stay in the hot path.
+collect() gathers the stage times of one block (a pair) on this thread,
+whether profiling is on or not.
+report() gives percentiles and a histogram per stage, dump_chrome_trace()
+writes a file for chrome://tracing or https://ui.perfetto.dev.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import NamedTuple
+
+import numpy as np
+
+_enabled = os.environ.get("ASTROPI_PROFILE", "") not in ("", "0")
+_NULL = nullcontext()
+_PID = os.getpid()
+# per thread: the stage -> seconds dict of an active collect() block
+_local = threading.local()
+
+
+class Span(NamedTuple):
+    name: str
+    start_ns: int       # perf_counter_ns
+    duration_ns: int
+    thread: int
+
+
+_spans: list[Span] = []
+_overruns: list[tuple[str, int, float, float]] = []     # (name, perf_counter_ns, elapsed s, budget s)
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def clear() -> None:
+    _spans.clear()
+    _overruns.clear()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        if _enabled:
+            # list.append is atomic, workers can record without a lock
+            _spans.append(Span(self.name, self.start, end - self.start, threading.get_ident()))
+        stages = getattr(_local, "stages", None)
+        if stages is not None:
+            stages[self.name] = stages.get(self.name, 0.0) + (end - self.start) / 1e9
+        return False
+
+
+def _active() -> bool:
+    return _enabled or getattr(_local, "stages", None) is not None
+
+
+def span(name: str):
+    """Context manager timing one stage"""
+    return _Span(name) if _active() else _NULL
+
+
+@contextmanager
+def collect():
+    """
+    Seconds per stage of the spans this thread runs inside the block (summed
+    if a stage repeats), also while profiling is off. Spans on pool threads
+    are only included if the work was wrapped in collected() and merged.
+
+        with collect() as stages:
+            EXIF.run(...)
+    """
+    stages: dict[str, float] = {}
+    outer = getattr(_local, "stages", None)
+    _local.stages = stages
+    try:
+        yield stages
+    finally:
+        _local.stages = outer
+
+
+def collected(func, *args, **kwargs):
+    """
+    func(*args, **kwargs) inside collect(), returns (result, stages). For
+    work handed to a pool thread, the caller adds the stages with merge().
+    """
+    with collect() as stages:
+        return func(*args, **kwargs), stages
+
+
+def merge(stages: dict[str, float]) -> None:
+    """Add stage times collected on another thread to this thread's collect() block, if there is one"""
+    mine = getattr(_local, "stages", None)
+    if mine is not None:
+        for name, seconds in stages.items():
+            mine[name] = mine.get(name, 0.0) + seconds
+
+
+def timed(name: str | None = None):
+    """Decorator version of span(), the stage name defaults to the function name"""
+    def decorator(func):
+        stage = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active():
+                return func(*args, **kwargs)
+            with _Span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def check_budget(name: str, elapsed: float, budget: float) -> bool:
+    """Print and remember an overrun as soon as it happens, True if `elapsed` was over `budget`"""
+    if elapsed <= budget:
+        return False
+    print(f"OVERRUN {name}: {elapsed:.2f} s > {budget:.2f} s budget")
+    _overruns.append((name, time.perf_counter_ns(), elapsed, budget))
+    return True
+
+
+def durations() -> dict[str, np.ndarray]:
+    """Seconds per stage, in the order the stages were first seen"""
+    by_name: dict[str, list[int]] = {}
+    for s in list(_spans):
+        by_name.setdefault(s.name, []).append(s.duration_ns)
+    return {name: np.array(ns) / 1e9 for name, ns in by_name.items()}
+
+
+def _histogram(seconds: np.ndarray, bins: int = 8, width: int = 30) -> list[str]:
+    counts, edges = np.histogram(seconds * 1000, bins=bins)
+    top = max(1, counts.max())
+    return [f"      {lo:9.2f} - {hi:9.2f} ms |{'#' * round(width * c / top):<{width}}| {c}"
+            for lo, hi, c in zip(edges[:-1], edges[1:], counts)]
+
+
+def report(histograms: bool = True) -> str:
+    lines = [f"{'stage':<16}{'n':>6}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+    for name, seconds in durations().items():
+        ms = seconds * 1000
+        p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+        lines.append(f"{name:<16}{len(ms):>6}{seconds.sum():>10.2f}{ms.mean():>10.1f}"
+                     f"{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{ms.max():>10.1f}")
+        if histograms and len(ms) >= 10:     # too few samples for a useful histogram otherwise
+            lines += _histogram(seconds)
+    if _overruns:
+        lines.append(f"{len(_overruns)} overruns: " + ", ".join(f"{n} {e:.2f}/{b:.2f} s" for n, _, e, b in _overruns))
+    return "\n".join(lines)
+
+
+def dump_chrome_trace(path: str) -> None:
+    """Trace Event Format, one complete event per span and an instant event per overrun"""
+    events = [{"name": s.name, "ph": "X", "ts": s.start_ns / 1000, "dur": s.duration_ns / 1000,
+               "pid": _PID, "tid": s.thread} for s in list(_spans)]
+    events += [{"name": f"overrun {name}", "ph": "i", "s": "g", "ts": ns / 1000, "pid": _PID, "tid": 0,
+                "args": {"elapsed_s": elapsed, "budget_s": budget}} for name, ns, elapsed, budget in _overruns]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,133 @@
+# scheduler.py
+"""
+Adaptive capture schedule.
+
+config.INTERVAL_S spreads 42 photos evenly over 10 minutes. The scheduler
+starts from that and, after every processed pair, picks the next interval
+from:
+
+- the budget: remaining time / remaining photos, so the run still ends on time
+- the processing latency: with WORKERS workers a pair may take up to
+  WORKERS intervals, faster capture only fills the queue
+- the measured ground motion: the shift between two photos stays above the
+  calc.minimum_pixel_diff threshold and below MAX_SHIFT of the frame, so
+  there is still overlap to match
+- the match quality: few matches or a low inlier ratio shortens the interval
+  (more overlap) for the next pair
+
+All times are time.monotonic() seconds.
+"""
+from __future__ import annotations
+
+import math
+import threading
+import time
+
+import calc
+from config import INTERVAL_S
+from orbit import get_height_at
+
+MIN_INTERVAL = 2.0      # s, never faster than the camera + file write
+MAX_SHIFT = 0.6         # at most this fraction of the frame between two photos
+MIN_INLIERS = 100
+MIN_INLIER_RATIO = 0.3
+POOR_QUALITY_FACTOR = 0.75
+LAST_PAIR_RESERVE = 5.0     # s kept for the last pair until a latency was measured (as in config.INTERVAL_S)
+DEADLINE_MARGIN = 1.0   # s of slack after the last pair, latencies vary
+LATENCY_SMOOTHING = 0.3     # weight of the newest latency in the running average
+MIN_USABLE = 0.2        # skip frames with less usable area than this (see EXIF.usable_fraction)
+
+
+class CaptureScheduler:
+    def __init__(self, deadline: float, max_photos: int, workers: int = 1, interval: float = INTERVAL_S,
+                 resolution: tuple[int, int] = calc.CAM_RESOLUTION, height: float | None = None):
+        self.deadline = deadline
+        self.max_photos = max_photos
+        self.workers = workers
+        self.resolution = resolution
+        self.height = height
+        self.interval = interval
+        # the threshold at the nominal interval, the least shift worth measuring
+        if height is None:
+            height = get_height_at(time.time())
+        self.min_shift = math.hypot(*calc.minimum_pixel_diff(INTERVAL_S, height))
+        self.photos = 0
+        self.latency: float | None = None        # running average, s per pair
+        self.capture_time = 0.0     # s from the scheduled shot until the photo is saved, last one
+        self.velocity: tuple[float, float] | None = None    # px/s on the sensor
+        self.poor_quality = False
+        self._last_shot: float | None = None
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float | None = None, velocity=None,
+                matches: int | None = None, inliers: int | None = None) -> None:
+        """Feedback from one processed pair, anything unknown can be left out"""
+        with self._lock:
+            if latency is not None:
+                self.latency = latency if self.latency is None else \
+                    (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+            if velocity is not None:
+                self.velocity = (float(velocity[0]), float(velocity[1]))
+            # no counts (e.g. the phase correlation tier) means nothing looked wrong
+            self.poor_quality = matches is not None and inliers is not None and \
+                (inliers < MIN_INLIERS or inliers < MIN_INLIER_RATIO * max(matches, 1))
+            self.interval = self._pick_interval(time.monotonic())
+
+    def _reserve(self) -> float:
+        # taking the last photo and processing the last pair
+        return self.capture_time + (LAST_PAIR_RESERVE if self.latency is None else self.latency) + DEADLINE_MARGIN
+
+    def _shift_bounds(self) -> tuple[float, float]:
+        # intervals that keep the frame to frame shift between the threshold and MAX_SHIFT
+        if self.velocity is None:
+            return 0.0, math.inf
+        vx, vy = abs(self.velocity[0]), abs(self.velocity[1])
+        speed = math.hypot(vx, vy)
+        if speed == 0:
+            return 0.0, math.inf
+        lower = self.min_shift / speed
+        w, h = self.resolution
+        upper = min(MAX_SHIFT * w / vx if vx else math.inf, MAX_SHIFT * h / vy if vy else math.inf)
+        return lower, upper
+
+    def _pick_interval(self, now: float) -> float:
+        remaining_photos = self.max_photos - self.photos
+        remaining_time = self.deadline - now - self._reserve()
+        interval = remaining_time / max(1, remaining_photos)
+
+        lower = MIN_INTERVAL
+        if self.latency is not None:
+            lower = max(lower, self.latency / self.workers)
+        shift_lower, shift_upper = self._shift_bounds()
+        lower = max(lower, shift_lower)
+
+        if self.poor_quality:
+            interval *= POOR_QUALITY_FACTOR
+        return max(lower, min(interval, shift_upper))
+
+    def next_shot(self) -> float | None:
+        """When to take the next photo, None once the photos or the time are used up"""
+        with self._lock:
+            if self.photos >= self.max_photos:
+                return None
+            if self._last_shot is None:
+                return time.monotonic()
+            shot_at = self._last_shot + self.interval
+            # the last pair still has to be processed before the deadline
+            if shot_at + self._reserve() > self.deadline:
+                return None
+            return shot_at
+
+    def shot_taken(self, at: float | None = None) -> None:
+        with self._lock:
+            self.photos += 1
+            now = time.monotonic()
+            self._last_shot = now if at is None else at
+            self.capture_time = now - self._last_shot
+            self.interval = self._pick_interval(self._last_shot)
+
+    @staticmethod
+    def wait_until(deadline: float) -> None:
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,5 @@
+# the modules live at the top of the repository, not in a package
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
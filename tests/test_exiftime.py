@@ -0,0 +1,133 @@
+# test_exiftime.py
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import exiftime
+from exiftime import read_time
+
+TAKEN = "2026:10:18 12:34:56"
+
+
+def _tiff(order: str, taken: str = TAKEN, subsec: str | None = None) -> bytes:
+    # TIFF header, IFD0 with only the Exif IFD pointer, Exif IFD with the two time tags
+    mark = b"II" if order == "<" else b"MM"
+    exif_ifd = 8 + 2 + 12 + 4
+    n = 1 if subsec is None else 2
+    data = exif_ifd + 2 + 12 * n + 4
+    date = taken.encode() + b"\x00"
+    tiff = mark + struct.pack(order + "HI", 42, 8)
+    tiff += struct.pack(order + "H", 1) + struct.pack(order + "HHII", 0x8769, 4, 1, exif_ifd) + b"\x00" * 4
+    tiff += struct.pack(order + "H", n)
+    tiff += struct.pack(order + "HHII", 0x9003, 2, len(date), data)
+    extra = b""
+    if subsec is not None:
+        raw = subsec.encode() + b"\x00"
+        if len(raw) <= 4:
+            field = raw.ljust(4, b"\x00")
+        else:
+            field = struct.pack(order + "I", data + len(date))
+            extra = raw
+        tiff += struct.pack(order + "HHI", 0x9291, 2, len(raw)) + field
+    return tiff + b"\x00" * 4 + date + extra
+
+
+def _segment(marker: int, payload: bytes) -> bytes:
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def _jpeg(tiff: bytes | None, before: tuple[bytes, ...] = ()) -> bytes:
+    body = b"\xff\xd8" + b"".join(before)
+    if tiff is not None:
+        body += _segment(0xE1, b"Exif\x00\x00" + tiff)
+    return body + _segment(0xDA, b"\x00" * 10) + b"\x12\x34" * 16 + b"\xff\xd9"
+
+
+@pytest.fixture(autouse=True)
+def _fresh_cache():
+    exiftime.clear_cache()
+    yield
+    exiftime.clear_cache()
+
+
+@pytest.mark.parametrize("order", ["<", ">"])
+@pytest.mark.parametrize("subsec, microsecond", [(None, 0), ("5", 500000), ("25", 250000),
+                                                 ("123", 123000), ("123456", 123456)])
+def test_byte_order_and_subsec(tmp_path, order, subsec, microsecond):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(_jpeg(_tiff(order, subsec=subsec)))
+    assert read_time(path) == datetime(2026, 10, 18, 12, 34, 56, microsecond)
+
+
+def test_segments_before_exif(tmp_path):
+    jfif = _segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+    xmp = _segment(0xE1, b"http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>")
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(_jpeg(_tiff("<", subsec="42"), before=(jfif, xmp)))
+    assert read_time(path) == datetime(2026, 10, 18, 12, 34, 56, 420000)
+
+
+def test_no_exif(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(_jpeg(None, before=(_segment(0xE0, b"JFIF\x00"),)))
+    with pytest.raises(ValueError, match="No datetime_original"):
+        read_time(path)
+
+
+def test_not_a_jpeg(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32)
+    with pytest.raises(ValueError):
+        read_time(path)
+
+
+@pytest.mark.parametrize("order, subsec, microsecond", [(">", "123456", 123456), ("<", "25", 250000)])
+def test_truncated(tmp_path, order, subsec, microsecond):
+    data = _jpeg(_tiff(order, subsec=subsec))
+    expected = datetime(2026, 10, 18, 12, 34, 56, microsecond)
+    path = tmp_path / "photo.jpg"
+    # a cut anywhere gives a clear ValueError or, if only padding was lost, the right time
+    for end in range(2, len(data)):
+        path.write_bytes(data[:end])
+        exiftime.clear_cache()
+        try:
+            taken = read_time(path)
+        except ValueError:
+            continue
+        assert taken == expected, end
+
+
+def test_cache_follows_the_file(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(_jpeg(_tiff("<")))
+    assert read_time(path).second == 56
+    path.write_bytes(_jpeg(_tiff("<", taken="2026:10:18 12:34:57", subsec="1")))
+    assert read_time(path) == datetime(2026, 10, 18, 12, 34, 57, 100000)
+
+
+def test_scan_directory(tmp_path):
+    for i in range(3):
+        (tmp_path / f"image_{i}.jpg").write_bytes(_jpeg(_tiff("<", taken=f"2026:10:18 12:34:5{i}")))
+    (tmp_path / "image_x.jpg").write_bytes(_jpeg(None))
+    (tmp_path / "notes.txt").write_text("not a photo")
+    times = exiftime.scan_directory(tmp_path)
+    assert sorted(p.name for p in times) == ["image_0.jpg", "image_1.jpg", "image_2.jpg"]
+    assert times[tmp_path / "image_2.jpg"].second == 52
+
+
+def test_same_as_exif_library(tmp_path):
+    exif = pytest.importorskip("exif")
+    pytest.importorskip("cv2")
+    from camera import encode_jpeg
+
+    taken = 1792300000.25
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(encode_jpeg(np.zeros((16, 16), np.uint8), taken))
+    with open(path, "rb") as f:
+        reference = exif.Image(f)
+    expected = datetime.strptime(reference.datetime_original, "%Y:%m:%d %H:%M:%S")
+    expected = expected.replace(microsecond=int(reference.subsec_time_original.ljust(6, "0")))
+    assert read_time(path) == expected
+    assert expected == datetime.fromtimestamp(taken, timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,118 @@
+# test_motion.py
+import math
+
+import numpy as np
+import pytest
+
+from motion import MotionModel, estimate_motion
+
+W, H = 4056, 3040
+CORNERS = np.array([[0, 0], [W, 0], [0, H], [W, H]], dtype=np.float64)
+
+
+def _similarity(angle_deg: float, scale: float, shift) -> np.ndarray:
+    c, s = scale * math.cos(math.radians(angle_deg)), scale * math.sin(math.radians(angle_deg))
+    return np.array([[c, -s, shift[0]], [s, c, shift[1]]])
+
+
+def _apply(M, pts):
+    return pts @ M[:, :2].T + M[:, 2]
+
+
+def _matches(M, n: int = 600, outliers: float = 0.3, noise: float = 0.0, seed: int = 0):
+    """pts1, pts2, descriptor distances and the true inlier mask of a synthetic pair"""
+    rng = np.random.default_rng(seed)
+    pts1 = rng.uniform([0, 0], [W, H], (n, 2))
+    pts2 = _apply(M, pts1) + rng.normal(0, noise, (n, 2)) if noise else _apply(M, pts1)
+    wrong = rng.random(n) < outliers
+    pts2[wrong] = rng.uniform([0, 0], [W, H], (wrong.sum(), 2))
+    # good matches tend to have smaller descriptor distances, as for ORB
+    distances = np.where(wrong, rng.uniform(20, 64, n), rng.uniform(0, 48, n))
+    return pts1, pts2, distances, ~wrong
+
+
+def _corner_error(M, M_true) -> float:
+    return float(np.abs(_apply(M, CORNERS) - _apply(M_true, CORNERS)).max())
+
+
+@pytest.mark.parametrize("M_true", [_similarity(0.05, 1.0, (-740, 30)), _similarity(-2.0, 1.01, (300, -500)),
+                                    _similarity(0.0, 1.0, (0, 0))])
+def test_exact_transform(M_true):
+    pts1, pts2, distances, inliers = _matches(M_true)
+    estimate = estimate_motion(pts1, pts2, distances)
+    assert estimate.method == "prosac"
+    assert _corner_error(estimate.M, M_true) < 1e-6
+    assert np.array_equal(estimate.inliers, inliers)
+
+
+def test_noisy_transform():
+    M_true = _similarity(0.05, 1.0, (-740, 30))
+    pts1, pts2, distances, inliers = _matches(M_true, noise=0.5, seed=1)
+    estimate = estimate_motion(pts1, pts2, distances)
+    assert _corner_error(estimate.M, M_true) < 0.3
+    # a few true matches with large noise may fall outside the threshold, no outlier gets in
+    assert not (estimate.inliers & ~inliers).any()
+    assert estimate.inliers.sum() >= 0.99 * inliers.sum()
+
+
+def test_without_distances():
+    M_true = _similarity(0.3, 1.0, (-740, 30))
+    pts1, pts2, _, inliers = _matches(M_true, seed=2)
+    estimate = estimate_motion(pts1, pts2)
+    assert _corner_error(estimate.M, M_true) < 1e-6
+    assert np.array_equal(estimate.inliers, inliers)
+
+
+def test_prior():
+    M_true = _similarity(0.05, 1.0, (-740, 30))
+    pts1, pts2, distances, inliers = _matches(M_true, seed=3)
+    # the previous pair moved a little differently
+    estimate = estimate_motion(pts1, pts2, distances, prior=_similarity(0.06, 1.0, (-741.5, 30.8)))
+    assert estimate.method == "prior"
+    assert estimate.iterations == 0
+    assert _corner_error(estimate.M, M_true) < 1e-6
+    assert np.array_equal(estimate.inliers, inliers)
+
+
+def test_wrong_prior_falls_back():
+    M_true = _similarity(0.05, 1.0, (-740, 30))
+    pts1, pts2, distances, inliers = _matches(M_true, seed=4)
+    estimate = estimate_motion(pts1, pts2, distances, prior=_similarity(0.0, 1.0, (-200, 400)))
+    assert estimate.method == "prosac"
+    assert _corner_error(estimate.M, M_true) < 1e-6
+
+
+def test_mostly_outliers_uses_ransac():
+    cv2 = pytest.importorskip("cv2")
+    M_true = _similarity(0.05, 1.0, (-740, 30))
+    pts1, pts2, distances, inliers = _matches(M_true, n=1000, outliers=0.9, seed=5)
+    estimate = estimate_motion(pts1, pts2, distances, max_iters=5000)
+    assert estimate.method == "ransac"
+    assert _corner_error(estimate.M, M_true) < 0.5
+
+
+def test_same_as_cv2_ransac():
+    cv2 = pytest.importorskip("cv2")
+    M_true = _similarity(0.05, 1.0, (-740, 30))
+    pts1, pts2, distances, inliers = _matches(M_true, noise=0.3, seed=6)
+    estimate = estimate_motion(pts1, pts2, distances)
+    M_cv, mask = cv2.estimateAffinePartial2D(pts1.astype(np.float32), pts2.astype(np.float32), method=cv2.RANSAC,
+                                             ransacReprojThreshold=3.0, maxIters=2000, confidence=0.999)
+    assert _corner_error(estimate.M, M_cv) < 0.2
+    assert (estimate.inliers == mask.ravel().astype(bool)).mean() > 0.99
+
+
+def test_too_few_matches():
+    with pytest.raises(ValueError):
+        estimate_motion(np.zeros((1, 2)), np.zeros((1, 2)))
+
+
+def test_motion_model_scales_translation():
+    model = MotionModel()
+    assert model.predict(10.0) is None
+    model.update(_similarity(0.05, 1.0, (-740, 30)), 14.5)
+    predicted = model.predict(29.0)
+    assert predicted[:, :2] == pytest.approx(_similarity(0.05, 1.0, (0, 0))[:, :2])
+    assert predicted[:, 2] == pytest.approx([-1480, 60])
+    model.reset()
+    assert model.predict(14.5) is None
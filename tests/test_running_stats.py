@@ -0,0 +1,56 @@
+# test_running_stats.py
+import numpy as np
+import pytest
+
+from calc import RunningStats, do_statistik
+
+
+def _speeds(n: int, seed: int = 0) -> np.ndarray:
+    # pair speeds around 7.66 km/s with a few bad pairs
+    rng = np.random.default_rng(seed)
+    speeds = rng.normal(7.66, 0.05, n)
+    bad = rng.random(n) < 0.1
+    speeds[bad] += rng.normal(0, 0.8, bad.sum())
+    return speeds
+
+
+def test_full_window():
+    stats = RunningStats(window=256)
+    speeds = _speeds(200)
+    for i, speed in enumerate(speeds, 1):
+        stats.add(speed)
+        if i < 2:
+            continue
+        mean, std = do_statistik(speeds[:i])
+        assert stats.estimate() == pytest.approx((mean, std), rel=1e-12, abs=1e-12)
+        assert stats.median() == pytest.approx(np.median(speeds[:i]), rel=1e-12)
+    assert len(stats) == stats.seen == 200
+
+
+@pytest.mark.parametrize("window", [1, 2, 7, 64])
+def test_sliding_window(window):
+    stats = RunningStats(window=window)
+    speeds = _speeds(3000, seed=window)
+    for i, speed in enumerate(speeds, 1):
+        stats.add(speed)
+        recent = speeds[max(0, i - window):i]
+        assert len(stats) == len(recent)
+        assert stats.std == pytest.approx(np.std(recent), abs=1e-9)
+        assert stats.median() == pytest.approx(np.median(recent), rel=1e-12)
+        if len(recent) >= 2:
+            assert stats.estimate() == pytest.approx(do_statistik(recent), abs=1e-9)
+
+
+def test_equal_samples():
+    # do_statistik's clip rejects everything here (nan), RunningStats keeps the plain mean
+    stats = RunningStats(window=4)
+    for _ in range(6):
+        stats.add(7.5)
+    assert stats.estimate() == (pytest.approx(7.5), pytest.approx(0.0, abs=1e-12))
+
+
+def test_empty():
+    with pytest.raises(ValueError):
+        RunningStats().estimate()
+    with pytest.raises(ValueError):
+        RunningStats(window=0)
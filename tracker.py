@@ -0,0 +1,244 @@
+# tracker.py
+"""
+Multi-frame velocity solver.
+
+Instead of one speed per photo pair, features are chained through the
+last `window` frames (frame k matched to k+1, like EXIF.run does) and one
+ground-track velocity is fitted to all tracks by least squares:
+
+    x_ik = a_i + v * t_k
+
+a_i is the unknown start of track i, t_k the capture time of frame k taken
+from the file name. Each detection is matched once but takes part in every
+pair of the window, so a track over 3 frames gives 3 differences.
+
+    python tracker.py images/ --window 3
+
+main.py feeds the pairs its workers already matched through add_matched(),
+in capture order, so nothing is matched twice.
+"""
+from __future__ import annotations
+
+import argparse
+from collections import deque
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import numpy as np
+
+import calc
+import EXIF
+
+CLIP_SIGMA = 3.0    # tracks further than this from the fit (in robust sigmas) are dropped
+MIN_TRACKS = 20
+
+
+class WindowEstimate(NamedTuple):
+    speed: float                    # km/s from the global fit
+    std: float                      # km/s, spread of the per-track speeds
+    velocity: tuple[float, float]   # px/s in the image plane
+    n_frames: int
+    n_tracks: int
+    n_observations: int
+
+
+class _Link(NamedTuple):
+    # inlier matches between two consecutive frames of the window
+    query: np.ndarray   # keypoint index in the older frame
+    train: np.ndarray   # keypoint index in the newer frame
+    pts1: np.ndarray    # (N, 2)
+    pts2: np.ndarray    # (N, 2)
+
+
+def build_tracks(links: list[_Link]):
+    """
+    Chain pairwise matches into tracks.
+    Returns (track, frame, pts): one row per observation, track ids start at 0.
+    """
+    track_ids: dict[tuple[int, int], int] = {}
+    track, frame, pts = [], [], []
+    n_tracks = 0
+    for k, link in enumerate(links):
+        for q, t, p1, p2 in zip(link.query.tolist(), link.train.tolist(), link.pts1, link.pts2):
+            tid = track_ids.get((k, q))
+            if tid is None:
+                tid = n_tracks
+                n_tracks += 1
+                track_ids[(k, q)] = tid
+                track.append(tid)
+                frame.append(k)
+                pts.append(p1)
+            if (k + 1, t) in track_ids:
+                continue    # two tracks ending on the same keypoint, keep the first
+            track_ids[(k + 1, t)] = tid
+            track.append(tid)
+            frame.append(k + 1)
+            pts.append(p2)
+    return np.array(track, dtype=int), np.array(frame, dtype=int), np.array(pts, dtype=np.float64).reshape(-1, 2)
+
+
+def fit_velocity(track: np.ndarray, times: np.ndarray, pts: np.ndarray):
+    """
+    Least squares v for x = a_track + v * t. The per-track offsets are
+    removed by centring every track on its own mean.
+    Returns (v, per-track v, per-track weight); tracks seen once get weight 0.
+    """
+    n = track.max() + 1
+    count = np.bincount(track, minlength=n)
+    dt = times - (np.bincount(track, times, n) / count)[track]
+    dx = pts - np.stack([np.bincount(track, pts[:, i], n) / count for i in (0, 1)], axis=1)[track]
+
+    weight = np.bincount(track, dt * dt, n)
+    num = np.stack([np.bincount(track, dt * dx[:, i], n) for i in (0, 1)], axis=1)
+    v = num.sum(axis=0) / weight.sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        v_track = num / weight[:, None]
+    return v, v_track, weight
+
+
+def _after(stamp, seconds: float):
+    # capture times are datetimes from EXIF or unix seconds from camera.Shot
+    return stamp + timedelta(seconds=seconds) if isinstance(stamp, datetime) else stamp + seconds
+
+
+class MultiFrameSolver:
+    """
+    Feed frames in capture order with add(); every call after the first
+    returns the estimate over the current window.
+    """
+
+    def __init__(self, window: int = 3, nfeatures: int = 4000, matcher: str = "bf", scale: float = 1.0,
+                 roi: bool = False, height: float | None = None):
+        if window < 2:
+            raise ValueError("window must be at least 2 frames")
+        self.window = window
+        self.nfeatures = nfeatures
+        self.matcher = matcher
+        self.scale = scale
+        self.roi = roi
+        self.height = height
+        self._images: deque[str] = deque(maxlen=window)
+        self._times: deque[float] = deque(maxlen=window)   # s since the first frame of the chain
+        self._stamps: deque = deque(maxlen=window)      # capture times, datetime or unix seconds
+        self._links: deque[_Link] = deque(maxlen=window - 1)
+        # every frame of the window is matched again by the next one
+        EXIF.FEATURE_STORE.maxsize = max(EXIF.FEATURE_STORE.maxsize, window + 1)
+
+    def reset(self) -> None:
+        self._images.clear()
+        self._times.clear()
+        self._stamps.clear()
+        self._links.clear()
+
+    def _start(self, image: str, stamp) -> None:
+        self.reset()
+        self._images.append(image)
+        self._times.append(0.0)
+        self._stamps.append(stamp)
+
+    def add_matched(self, image_1: str, image_2: str, matched: EXIF.MatchedPair) -> WindowEstimate:
+        """
+        Extend the window by a pair that is already matched (EXIF.last.matched).
+        A pair that doesn't continue the chain from the newest frame starts a new one.
+        """
+        image_1, image_2 = str(image_1), str(image_2)
+        if not self._images or self._images[-1] != image_1:
+            self._start(image_1, matched.time)
+        self._links.append(_Link(matched.matches["query"].astype(int), matched.matches["train"].astype(int),
+                                 matched.pts1.reshape(-1, 2), matched.pts2.reshape(-1, 2)))
+        self._times.append(self._times[-1] + matched.time_difference)
+        self._stamps.append(_after(matched.time, matched.time_difference))
+        self._images.append(image_2)
+        return self.estimate()
+
+    def add(self, image: str) -> WindowEstimate | None:
+        image = str(image)
+        if not self._images:
+            self._start(image, EXIF.get_time(image))
+            return None
+
+        previous = self._images[-1]
+        time_difference = EXIF.get_time_difference(previous, image)
+        if time_difference <= 0:
+            raise ValueError("Time difference is zero or negative.")
+        time = EXIF.get_time(previous)
+        orbit_state = calc.get_orbit_state(time, height=self.height)
+
+        frame_1 = EXIF.load_frame(previous, self.nfeatures, scale=self.scale, roi=self.roi)
+        frame_2 = EXIF.load_frame(image, self.nfeatures, scale=self.scale, roi=self.roi)
+        try:
+            matches, pts1, pts2 = EXIF.match_frames(frame_1, frame_2, time, time_difference, orbit_state,
+                                                    self.matcher, self.scale)
+        except ValueError:
+            # the chain is broken, start a new window from this frame
+            self._start(image, EXIF.get_time(image))
+            raise
+        return self.add_matched(previous, image, EXIF.MatchedPair(time, time_difference, matches, pts1, pts2))
+
+    def estimate(self) -> WindowEstimate:
+        track, frame, pts = build_tracks(list(self._links))
+        times = np.array(self._times)[frame]
+
+        v, v_track, weight = fit_velocity(track, times, pts)
+        # one sigma clip on the per-track velocities, then refit
+        used = weight > 0
+        residual = np.linalg.norm(v_track - v, axis=1)
+        sigma = 1.4826 * np.median(residual[used])
+        keep = used & (residual <= CLIP_SIGMA * max(sigma, 1e-9))
+        if keep.sum() < MIN_TRACKS:
+            raise ValueError(f"Too few tracks ({keep.sum()}).")
+        observed = keep[track]
+        track_kept = np.unique(track[observed], return_inverse=True)[1]
+        v, v_track, weight = fit_velocity(track_kept, times[observed], pts[observed])
+
+        # speed of the fitted motion at the track centres, over the median frame interval
+        time_difference = float(np.median(np.diff(self._times)))
+        centres = np.stack([np.bincount(track_kept, pts[observed][:, i]) / np.bincount(track_kept)
+                            for i in (0, 1)], axis=1)
+        mid = _after(self._stamps[0], (self._times[-1] - self._times[0]) / 2)
+        state = calc.get_orbit_state(mid, height=self.height)
+
+        step = v * time_difference / 2
+        speed = calc.get_speeds(centres - step, centres + step, mid, time_difference, state=state)
+        track_step = v_track * time_difference / 2
+        track_speeds = calc.get_speeds(centres - track_step, centres + track_step, mid, time_difference, state=state)
+        track_speeds = track_speeds[calc.speed_mask(track_speeds)]
+        if len(track_speeds) == 0:
+            raise ValueError("Tracker failed, output out of expected range")
+
+        return WindowEstimate(float(np.median(speed)), float(np.std(track_speeds)), (float(v[0]), float(v[1])),
+                              len(self._images), int(len(centres)), int(observed.sum()))
+
+
+def _cli():
+    from batch import list_frames
+
+    p = argparse.ArgumentParser(description="ISS speed from feature tracks over a sliding window of frames")
+    p.add_argument("directory")
+    p.add_argument("--prefix", default="image", help="File name prefix used by fotak.take_photo")
+    p.add_argument("--window", type=int, default=3, help="Frames per window")
+    p.add_argument("--nfeatures", type=int, default=4000)
+    p.add_argument("--matcher", default="bf")
+    p.add_argument("--scale", type=float, default=1.0)
+    p.add_argument("--roi", action="store_true")
+    args = p.parse_args()
+
+    solver = MultiFrameSolver(args.window, args.nfeatures, args.matcher, args.scale, args.roi)
+    estimates = []
+    for image in list_frames(args.directory, args.prefix):
+        try:
+            estimate = solver.add(image)
+        except ValueError as e:
+            print(f"image: {image}, failed: {e}")
+            continue
+        if estimate is not None:
+            estimates.append(estimate.speed)
+            print(f"image: {image}, speed: {estimate.speed:.03f} +- {estimate.std:.03f} km/s "
+                  f"({estimate.n_tracks} tracks over {estimate.n_frames} frames)")
+    if estimates:
+        speed, std = calc.do_statistik(estimates) if len(estimates) > 1 else (estimates[0], 0.0)
+        print(f"speed: {speed:.03f} +- {std:.03f} km/s")
+
+
+if __name__ == "__main__":
+    _cli()